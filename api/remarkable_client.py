@@ -1,7 +1,12 @@
 
 import os
-from io import BytesIO
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta
 import requests
+from requests.adapters import HTTPAdapter
 from uuid import uuid4
 from pathlib import Path
 import json
@@ -25,16 +30,47 @@ EVENT_ONETIMECODE_NEEDED = 4
 # CONSTANTS
 #
 USER_AGENT = "remapy"
+# Default urls; can be changed with network.base_url and network.auth_url
+# (e.g. to test against test/cloud_server.py)
 BASE_URL = "https://document-storage-production-dot-remarkable-production.appspot.com"
-DEVICE_TOKEN_URL = "https://webapp-production-dot-remarkable-production.appspot.com/token/json/2/device/new"
-USER_TOKEN_URL = "https://webapp-production-dot-remarkable-production.appspot.com/token/json/2/user/new"
+AUTH_URL = "https://webapp-production-dot-remarkable-production.appspot.com"
+DEVICE_TOKEN_URL = "/token/json/2/device/new"
+USER_TOKEN_URL = "/token/json/2/user/new"
 DEVICE = "mobile-android"
 SERVICE_MGR_URL = "https://service-manager-production-dot-remarkable-production.appspot.com"
 
-LIST_DOCS_URL = BASE_URL + "/document-storage/json/2/docs"
-UPDATE_STATUS_URL = BASE_URL + "/document-storage/json/2/upload/update-status"
-UPLOAD_REQUEST_URL = BASE_URL + "/document-storage/json/2/upload/request"
-DELETE_ENTRY_URL = BASE_URL + "/document-storage/json/2/delete"
+LIST_DOCS_URL = "/document-storage/json/2/docs"
+UPDATE_STATUS_URL = "/document-storage/json/2/upload/update-status"
+UPLOAD_REQUEST_URL = "/document-storage/json/2/upload/request"
+DELETE_ENTRY_URL = "/document-storage/json/2/delete"
+
+# Number of threads that sync items in parallel (config: network.workers)
+NETWORK_WORKERS = 10
+
+# Max. number of hosts for which connections are kept alive
+POOL_HOSTS = 8
+
+REQUEST_TIMEOUT = 60*2
+
+# Downloads are written to disk in chunks of this size
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Failed downloads are resumed up to network.retries times. The n-th
+# retry waits network.backoff * 2^n seconds (+-50% jitter), at most
+# DOWNLOAD_MAX_BACKOFF seconds.
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_BACKOFF = 1.0
+DOWNLOAD_MAX_BACKOFF = 30.0
+
+BLOB_KEYS = ["BlobURLGet", "BlobURLGetExpires", "BlobURLPut", "BlobURLPutExpires"]
+
+# Unfinished downloads are kept in this directory (next to the target
+# file) such that they can be resumed later. It starts with a dot, so
+# it is not removed as unknown item from the data directory.
+PARTIAL_DIR = ".partial"
+
+# Blob urls are refreshed if they expire within this time
+BLOB_URL_EXPIRY_MARGIN = timedelta(seconds=60)
 
 
 #
@@ -64,9 +100,97 @@ class RemarkableClient():
                     print(e)
 
 
+    class ConnectionPool(metaclass=Singleton):
+        """ Keep-alive session which is shared by all clients and threads.
+            The number of connections per host follows the number of
+            workers (config: network.workers) and can be limited with
+            network.connections_per_host.
+        """
+
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.session = None
+
+        def get_session(self):
+            with self.lock:
+                if self.session is None:
+                    workers = get_worker_count()
+                    connections = cfg.get("network.connections_per_host", workers)
+                    adapter = HTTPAdapter(
+                        pool_connections=POOL_HOSTS,
+                        pool_maxsize=connections,
+                        pool_block=True)
+
+                    self.session = requests.Session()
+                    self.session.headers["user-agent"] = USER_AGENT
+                    self.session.mount("https://", adapter)
+                    self.session.mount("http://", adapter)
+                return self.session
+
+        def stats(self):
+            """ Returns the number of requests, opened connections and
+                reused connections of all pooled hosts.
+            """
+            requests_sent, connections = 0, 0
+            with self.lock:
+                adapters = set(self.session.adapters.values()) if self.session else set()
+            for adapter in adapters:
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools.get(key)
+                    if pool is None:
+                        continue
+                    requests_sent += pool.num_requests
+                    connections += pool.num_connections
+
+            return {
+                "requests": requests_sent,
+                "opened": connections,
+                "reused": max(0, requests_sent - connections)
+            }
+
+        def close(self):
+            with self.lock:
+                if self.session is not None:
+                    self.session.close()
+                    self.session = None
+
+
+    class BlobUrlCache(metaclass=Singleton):
+        """ Download urls (BlobURLGet) of documents together with their
+            expiration date (BlobURLGetExpires).
+        """
+
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.urls = {}
+
+        def get(self, id):
+            """ Returns the url or None if it is not cached or expired.
+            """
+            with self.lock:
+                entry = self.urls.get(id)
+            if entry is None:
+                return None
+
+            url, expires = entry
+            if expires is not None and expires - BLOB_URL_EXPIRY_MARGIN <= datetime.utcnow():
+                return None
+            return url
+
+        def put(self, items):
+            with self.lock:
+                for item in items:
+                    url = item.get("BlobURLGet", "")
+                    if url:
+                        self.urls[item["ID"]] = (url, _parse_expires(item.get("BlobURLGetExpires")))
+
+
     def __init__(self):
         self.test = True
         self.listener_handler = self.SignInListenerHandler()
+        self.connection_pool = self.ConnectionPool()
+        self.blob_urls = self.BlobUrlCache()
 
     def listen_sign_in_event(self, subscriber):
         self.listener_handler.listen_sign_in_event(subscriber)
@@ -111,7 +235,9 @@ class RemarkableClient():
 
 
     def get_item(self, id):
-
+        """ Returns the metadata (with download url) of the given item or
+            None if it does not exist (anymore) or the request failed.
+        """
         response = self._request("GET", LIST_DOCS_URL, params={
             "doc": id,
             "withBlob": True
@@ -119,11 +245,39 @@ class RemarkableClient():
 
         if response.ok:
             items = response.json()
+            if len(items) <= 0:
+                return None
+
+            self.blob_urls.put(items)
             return items[0]
 
         return None
 
 
+    def refresh_blob_url(self, id):
+        """ Request a new download url for the given document. Returns
+            None if no url is available (e.g. the document was deleted).
+        """
+        item = self.get_item(id)
+        if item is None or not item.get("BlobURLGet"):
+            return None
+        return item["BlobURLGet"]
+
+
+    def get_blob_url(self, id):
+        """ Returns the download url of the given document. Urls fetched
+            with list_items(with_blob=True) are used until they expire.
+            Missing or expired urls are requested for this document only;
+            the cached urls of all other documents are kept. Returns None
+            if no url is available.
+        """
+        url = self.blob_urls.get(id)
+        if url is not None:
+            return url
+
+        return self.refresh_blob_url(id)
+
+
     def delete_item(self, id, version):
 
         response = self._request("PUT", DELETE_ENTRY_URL, body=[{
@@ -137,12 +291,37 @@ class RemarkableClient():
         return False
 
 
-    def list_items(self):
-        response = self._request("GET", LIST_DOCS_URL)
+    def delete_items(self, items):
+        """ Delete many items ({"ID", "Version"}) in one request. Returns
+            the result of every item ({"ID", "Success", "Message"}) or None
+            if the request failed.
+        """
+        response = self._request("PUT", DELETE_ENTRY_URL, body=items)
+        if not response.ok:
+            print("(Error) Deletion of %d items failed" % len(items))
+            return None
+
+        return response.json()
+
+
+    def list_items(self, with_blob=False):
+        """ Returns the metadata of all items. If with_blob is set, the
+            download urls of all documents are requested in the same call
+            and cached, see get_blob_url.
+        """
+        params = {"withBlob": True} if with_blob else None
+        response = self._request("GET", LIST_DOCS_URL, params=params)
 
         if response.ok:
             items = response.json()
 
+            # Blob urls expire, therefore they are not part of the metadata
+            if with_blob:
+                self.blob_urls.put(items)
+                for item in items:
+                    for key in BLOB_KEYS:
+                        item.pop(key, None)
+
             # Logging only
             # items_str = json.dumps(items, indent=4)
             # with open("all_files.json", "wt") as f:
@@ -152,16 +331,113 @@ class RemarkableClient():
         return None
 
 
-    def get_raw_file(self, blob_url):
-        stream = self._request("GET", blob_url, stream=True)
-        zip_io = BytesIO()
-        for chunk in stream.iter_content(chunk_size=8192):
-            zip_io.write(chunk)
-        return zip_io.getbuffer()
+    def get_raw_file(self, blob_url, path, refresh_url=None):
+        """ Download the given blob into path. The response is streamed
+            into PARTIAL_DIR/<name>.part in chunks such that memory usage
+            is bounded and path only exists if the download is complete.
+            If the connection fails, the download is resumed with a range
+            request (also in a later call for the same path). refresh_url
+            is called to get a new url if the server rejects the current
+            one (e.g. because it expired). Returns the number of bytes
+            downloaded.
+        """
+        path_part = get_path_part(path)
+        os.makedirs(os.path.dirname(path_part), exist_ok=True)
+        path_etag = "%s.etag" % path_part
+        retries = int(cfg.get("network.retries", DOWNLOAD_RETRIES))
+        backoff = float(cfg.get("network.backoff", DOWNLOAD_BACKOFF))
+        start = time.perf_counter()
+        resumed = os.path.getsize(path_part) if os.path.exists(path_part) else 0
+
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                delay = min(DOWNLOAD_MAX_BACKOFF, backoff * 2 ** (attempt - 1))
+                time.sleep(delay * random.uniform(0.5, 1.5))
+
+            try:
+                size, total = self._download_part(blob_url, path_part, path_etag)
+            except requests.exceptions.HTTPError as e:
+                status = e.response.status_code
+                if status in (400, 401, 403) and refresh_url is not None:
+                    print("(Warning) Download url rejected (%d), requesting a new one." % status)
+                    blob_url = refresh_url()
+                    if blob_url is None:
+                        raise Exception("Download url rejected (%d) and no new url available" % status)
+                    continue
+                if status < 500 and status != 429:
+                    raise e
+                print("(Warning) Download failed (%s), retry %d of %d" % (e, attempt + 1, retries))
+                continue
+            except requests.exceptions.RequestException as e:
+                print("(Warning) Download failed (%s), retry %d of %d" % (e, attempt + 1, retries))
+                continue
+
+            if total is not None and size != total:
+                print("(Warning) Download incomplete (%d of %d bytes), retry %d of %d" % (
+                    size, total, attempt + 1, retries))
+                continue
+
+            os.replace(path_part, path)
+            if os.path.exists(path_etag):
+                os.remove(path_etag)
+
+            downloaded = max(0, size - resumed)
+            duration = max(time.perf_counter() - start, 1e-6)
+            print("Downloaded %.1f MB in %.1fs (%.1f MB/s)" % (
+                downloaded / 1024 / 1024, duration, downloaded / 1024 / 1024 / duration))
+            return size
+
+        raise Exception("Download failed after %d retries" % retries)
+
+
+    def _download_part(self, blob_url, path_part, path_etag):
+        """ Continue the download in path_part. The etag of the blob is
+            stored such that the server sends the complete blob again
+            (If-Range) if it changed in between. Returns the size of the
+            part file and the total size (if known).
+        """
+        offset = os.path.getsize(path_part) if os.path.exists(path_part) else 0
+        etag = None
+        if os.path.exists(path_etag):
+            with open(path_etag, "r") as f:
+                etag = f.read()
+
+        # Resume only if we know that it is still the same blob
+        headers = {}
+        if offset > 0 and etag:
+            headers["Range"] = "bytes=%d-" % offset
+            headers["If-Range"] = etag
+        else:
+            offset = 0
+
+        with self._request("GET", blob_url, headers=headers, stream=True) as response:
+            if response.status_code == 416:
+                # Nothing left to download
+                return offset, offset
+            response.raise_for_status()
+
+            total = _get_total_size(response)
+            if response.status_code != 206:
+                offset = 0
+
+            new_etag = response.headers.get("ETag")
+            if new_etag:
+                with open(path_etag, "w") as f:
+                    f.write(new_etag)
+
+            with open(path_part, "ab" if offset > 0 else "wb") as out:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    out.write(chunk)
 
+        return os.path.getsize(path_part), total
 
-    def upload(self, id, metadata, zip_file):
-        response = self._request("PUT", "/document-storage/json/2/upload/request",
+
+    def upload(self, id, metadata, zip_file, progress_listener=None):
+        """ Upload the given zip (a file object) of a new document. The
+            file is streamed in chunks; progress_listener(sent, total) is
+            called after every chunk.
+        """
+        response = self._request("PUT", UPLOAD_REQUEST_URL,
                            body=[{
                                "ID": id,
                                "Type": "DocumentType",
@@ -174,7 +450,9 @@ class RemarkableClient():
         response = response.json()
         blob_url = response[0].get("BlobURLPut", None)
 
-        response = self._request("PUT", blob_url, data=zip_file.getvalue())
+        zip_file.seek(0)
+        body = UploadStream(zip_file, progress_listener)
+        response = self._request("PUT", blob_url, data=body)
         zip_file.seek(0)
         if not response.ok:
             print("(Error) Upload request failed")
@@ -192,6 +470,19 @@ class RemarkableClient():
         return self.get_item(metadata["ID"])
 
 
+    def update_metadata_list(self, metadata_list):
+        """ Update the metadata of many items in one request. Returns the
+            result of every item ({"ID", "Version", "Success", "Message"})
+            or None if the request failed.
+        """
+        response = self._request("PUT", UPDATE_STATUS_URL, body=metadata_list)
+        if not response.ok:
+            print("(Error) Update of %d items failed" % len(metadata_list))
+            return None
+
+        return response.json()
+
+
     def _get_device_token(self, one_time_code):
         """ Create a new device for a given one_time_code to be able to
             connect to the rm cloud
@@ -201,7 +492,7 @@ class RemarkableClient():
             "deviceDesc": DEVICE,
             "deviceID": str(uuid4()),
         }
-        response = self._request("POST", DEVICE_TOKEN_URL, body=body)
+        response = self._request("POST", get_auth_url() + DEVICE_TOKEN_URL, body=body)
         if response.ok:
             device_token = response.text
             return device_token
@@ -217,7 +508,7 @@ class RemarkableClient():
             return None
 
         try:
-            response = self._request("POST", USER_TOKEN_URL, None, headers={
+            response = self._request("POST", get_auth_url() + USER_TOKEN_URL, None, headers={
                     "Authorization": "Bearer %s" % device_token
             })
         except:
@@ -249,15 +540,13 @@ class RemarkableClient():
             the server.
         """
 
-        config = cfg.load()
-
         if headers is None:
             headers = {}
 
         if not path.startswith("http"):
             if not path.startswith('/'):
                 path = '/' + path
-            url = "%s%s" % (BASE_URL, path)
+            url = "%s%s" % (get_base_url(), path)
         else:
             url = path
 
@@ -272,14 +561,94 @@ class RemarkableClient():
         for k in headers.keys():
             _headers[k] = headers[k]
 
-        r = requests.request(method, url,
-                             json=body,
-                             data=data,
-                             headers=_headers,
-                             params=params,
-                             stream=stream,
-                             timeout=60*2)
+        session = self.connection_pool.get_session()
+        r = session.request(method, url,
+                            json=body,
+                            data=data,
+                            headers=_headers,
+                            params=params,
+                            stream=stream,
+                            timeout=REQUEST_TIMEOUT)
         return r
 
 
+    def connection_stats(self):
+        return self.connection_pool.stats()
+
+
+class UploadStream(object):
+    """ File-like wrapper that reports the progress while requests reads
+        the body. The length is known in advance such that the body is
+        sent with a Content-Length instead of chunked encoding.
+    """
+
+    def __init__(self, file, progress_listener=None):
+        self.file = file
+        self.progress_listener = progress_listener
+        self.sent = 0
+
+        position = file.tell()
+        file.seek(0, os.SEEK_END)
+        self.total = file.tell() - position
+        file.seek(position)
+
+    def __len__(self):
+        return self.total
+
+    def read(self, size=-1):
+        chunk = self.file.read(size)
+        self.sent += len(chunk)
+        if self.progress_listener is not None and len(chunk) > 0:
+            self.progress_listener(self.sent, self.total)
+        return chunk
+
+
+#
+# HELPER
+#
+def get_base_url():
+    return cfg.get("network.base_url", BASE_URL).rstrip("/")
+
+
+def get_auth_url():
+    return cfg.get("network.auth_url", AUTH_URL).rstrip("/")
+
+
+def get_path_part(path):
+    """ Path of the unfinished download of the given file.
+    """
+    return os.path.join(os.path.dirname(path), PARTIAL_DIR, "%s.part" % os.path.basename(path))
+
+
+def get_worker_count():
+    return max(1, int(cfg.get("network.workers", NETWORK_WORKERS)))
+
+
+def _get_total_size(response):
+    """ Size of the complete blob from Content-Range (206) or
+        Content-Length (200) or None if unknown.
+    """
+    if response.status_code == 206:
+        match = re.match(r"bytes \d+-\d+/(\d+)", response.headers.get("Content-Range", ""))
+        return int(match.group(1)) if match else None
+
+    if "Content-Encoding" in response.headers:
+        return None
+    length = response.headers.get("Content-Length")
+    return int(length) if length is not None else None
+
+
+def _parse_expires(expires):
+    """ Parse BlobURLGetExpires (e.g. 2020-06-07T16:38:25.613397766Z)
+        into a utc datetime. Returns None if not available.
+    """
+    if not expires or expires.startswith("0001-"):
+        return None
+
+    try:
+        return datetime.strptime(expires[:19], "%Y-%m-%dT%H:%M:%S")
+    except ValueError:
+        return None
+
+
 
@@ -3,7 +3,6 @@ import sys
 import subprocess
 import threading
 import shutil
-import queue
 import uuid
 import webbrowser
 from time import gmtime, strftime
@@ -25,6 +24,9 @@ from model.item_manager import ItemManager
 from model.item import Item
 import model.document
 from model.document import Document
+import model.sync_engine
+from model.sync_engine import SyncEngine
+from model.local_store import LocalStore
 import utils.config
 
 
@@ -47,6 +49,7 @@ class FileExplorer(object):
         self.nodes = dict()
         self.rm_client = RemarkableClient()
         self.item_manager = ItemManager()
+        self.sync_engine = SyncEngine()
 
         self.tree_style = ttk.Style()
         self.tree_style.configure("remapy.style.Treeview", highlightthickness=0, bd=0, font=font_size, rowheight=row_height)
@@ -474,6 +477,7 @@ class FileExplorer(object):
             return
 
         # Clean everything, also if some (old) things exist
+        LocalStore().close()
         shutil.rmtree(utils.config.PATH, ignore_errors=True)
         Path(utils.config.PATH).mkdir(parents=True, exist_ok=True)
 
@@ -502,7 +506,8 @@ class FileExplorer(object):
                 force=False,
                 open_file=False,
                 open_original=False,
-                open_oap=False)
+                open_oap=False,
+                priority=model.sync_engine.PRIORITY_BACKGROUND)
 
 
     def _sync_selection_async(self, force=False, open_file=False, open_original=False, open_oap=False):
@@ -511,87 +516,73 @@ class FileExplorer(object):
         self._sync_items_async(items, force, open_file, open_original, open_oap)
 
 
-    def _sync_items_async(self, items, force, open_file, open_original, open_oap):
-        """ To keep the gui responsive...
+    def _sync_items_async(self, items, force, open_file, open_original, open_oap, priority=None):
+        """ To keep the gui responsive items are synced by the sync engine.
+            We only listen to its events. Documents that should be opened
+            are synced before all others.
         """
-        thread = threading.Thread(target=self._sync_items, args=(items, force, open_file, open_original, open_oap))
-        thread.start()
+        if priority is None:
+            priority = model.sync_engine.PRIORITY_OPEN if open_file else model.sync_engine.PRIORITY_USER
 
+        def listener(code, job, item):
+            if code == model.sync_engine.SYNC_ITEM_SUCCESS:
+                self.log_console("Synced '%s'" % item.full_name())
 
-    def _sync_items(self, items, force, open_file, open_original, open_oap):
-        q = queue.Queue()
-        threads = []
-
-        def worker():
-            while True:
-                item = q.get()
-                if item is None:
-                    break
-
-                try:
-                    self._sync_and_open_item(item, force, open_file, open_original, open_oap)
-                except Exception as e:
-                    if open_file:
-                        self.log_console("(Error) Could not open '%s'" % item.name())
-                    else:
-                        self.log_console("(Error) Could not sync '%s'" % item.name())
-                    print(e)
-
-                q.task_done()
-
-        num_worker_threads = 10
-        for i in range(num_worker_threads):
-            t = threading.Thread(target=worker)
-            t.start()
-            threads.append(t)
-
-        # Add all items and child items
-        for item in items:
-            self.item_manager.traverse_tree(fun=q.put, item = item)
-
-        q.join()
+            elif code == model.sync_engine.SYNC_ITEM_FAILED:
+                if open_file:
+                    self.log_console("(Error) Could not open '%s'" % item.name())
+                else:
+                    self.log_console("(Error) Could not sync '%s'" % item.name())
+                print(job.errors[item.id()])
 
-        # stop workers
-        for i in range(num_worker_threads):
-            q.put(None)
-        for t in threads:
-            t.join()
+            elif code == model.sync_engine.SYNC_DONE:
+                if utils.config.get("debug.connection_stats", False):
+                    stats = self.rm_client.connection_stats()
+                    self.log_console("Requests: %d, connections opened: %d, reused: %d" % (
+                        stats["requests"], stats["opened"], stats["reused"]))
 
+                if None in job.errors:
+                    self.log_console("(Error) Sync failed (%s)" % job.errors[None])
+                    return
 
-    def _sync_and_open_item(self, item, force, open_file, open_original, open_oap):
+                # Failed documents were reported already and are not opened
+                if open_file:
+                    self._open_items(
+                        [item for item in items if item.id() not in job.errors],
+                        open_original, open_oap)
 
-        if item.state == model.item.STATE_SYNCING:
-            self.log_console("Already syncing '%s'" %  item.full_name())
-            return
+        self.sync_engine.sync(items, force, listener, priority)
 
-        if (force or item.state != model.item.STATE_SYNCED) and not item.is_root():
-            item.sync()
 
-            if item.is_document():
-                self.log_console("Synced '%s'" %  item.full_name())
-
-        if open_file and item.is_document():
-            if open_original:
-                file_to_open = item.orig_file()
-            elif open_oap:
-                file_to_open = item.oap_file()
-                if file_to_open == None:
-                    messagebox.showinfo("Information", "Document is not annotated.", icon='info')
-                    return
-            else:
-                file_to_open = item.ann_or_orig_file()
+    def _open_items(self, items, open_original, open_oap):
+        # Every viewer blocks until it is closed
+        for item in items:
+            if item.is_document() and item.state != model.item.STATE_SYNCING:
+                threading.Thread(target=self._open_item, args=(item, open_original, open_oap)).start()
+
+
+    def _open_item(self, item, open_original, open_oap):
+        if open_original:
+            file_to_open = item.orig_file()
+        elif open_oap:
+            file_to_open = item.oap_file()
+            if file_to_open == None:
+                messagebox.showinfo("Information", "Document is not annotated.", icon='info')
+                return
+        else:
+            file_to_open = item.ann_or_orig_file()
 
-            if sys.platform == "win32":
-                os.startfile(os.path.normpath(file_to_open))
-            else:
-                if file_to_open.endswith(".pdf"):
-                    try:
-                        current_page = 0 if open_oap else item.current_page()
-                        subprocess.call(["evince", "-i", str(current_page), file_to_open])
-                    except:
-                        subprocess.call(["xdg-open", file_to_open])
-                else:
+        if sys.platform == "win32":
+            os.startfile(os.path.normpath(file_to_open))
+        else:
+            if file_to_open.endswith(".pdf"):
+                try:
+                    current_page = 0 if open_oap else item.current_page()
+                    subprocess.call(["evince", "-i", str(current_page), file_to_open])
+                except:
                     subprocess.call(["xdg-open", file_to_open])
+            else:
+                subprocess.call(["xdg-open", file_to_open])
 
 
     #
@@ -621,6 +612,8 @@ class FileExplorer(object):
             return
 
         def run():
+            items_to_delete = []
+            items_to_trash = []
             for item in items:
                 if item.name() == "Quick sheets" and item.parent().is_root():
                     self.log_console("(Warning) You can not delete the Quick sheets.")
@@ -631,11 +624,17 @@ class FileExplorer(object):
                     continue
 
                 if item.parent().id() == "trash":
-                    item.delete()
-                    self.log_console("Deleted %s" % item.full_name())
+                    items_to_delete.append(item)
                 else:
-                    trash = self.item_manager.trash
-                    self._move(item, trash)
+                    items_to_trash.append(item)
+
+            if len(items_to_delete) > 0:
+                deleted, failed = self.item_manager.delete_items(items_to_delete)
+                self.log_console("Deleted %d item(s)" % len(deleted))
+                for item, message in failed:
+                    self.log_console("(Error) Could not delete '%s' (%s)" % (item.full_name(), message))
+
+            self._move(items_to_trash, self.item_manager.trash)
 
         threading.Thread(target=run).start()
 
@@ -648,33 +647,46 @@ class FileExplorer(object):
         items = [self.item_manager.get_item(id) for id in selected_ids]
 
         def run():
+            items_to_restore = []
             for item in items:
                 if item.parent().id() != "trash":
                     self.log_console("(Warning) Restore of '%s' not necessary." % item.full_name())
                     continue
 
-                self._move(item, self.item_manager.root)
+                items_to_restore.append(item)
+
+            self._move(items_to_restore, self.item_manager.root)
 
         threading.Thread(target=run).start()
 
 
-    def _move(self, item, new_parent):
-        old_parent_id = item.parent().id()
+    def _move(self, items, new_parent):
+        if len(items) <= 0:
+            return
+
+        old_parent_ids = {item.id(): item.parent().id() for item in items}
 
-        # Move on cloud
-        item.move(new_parent)
+        # Move on cloud (in batches)
+        failed = self.item_manager.move(items, new_parent)
+        failed_ids = set(item.id() for item, _ in failed)
+        for item, message in failed:
+            self.log_console("(Error) Could not move '%s' (%s)" % (item.full_name(), message))
 
-        # Remove from old parent (tree view)
-        old_parent_children = list(self.tree.get_children(old_parent_id))
-        old_parent_children.remove(item.id())
-        self.tree.set_children(old_parent_id, *old_parent_children)
+        moved = [item for item in items if item.id() not in failed_ids]
+        moved_ids = set(item.id() for item in moved)
 
-        # Add to trash (tree view)
+        # Remove from old parents (tree view)
+        for old_parent_id in set(old_parent_ids[id] for id in moved_ids):
+            old_parent_children = [c for c in self.tree.get_children(old_parent_id) if c not in moved_ids]
+            self.tree.set_children(old_parent_id, *old_parent_children)
+
+        # Add to new parent (tree view)
         new_parent_children = list(self.tree.get_children(new_parent.id()))
-        new_parent_children.append(item.id())
+        new_parent_children.extend(item.id() for item in moved)
         self.tree.set_children(new_parent.id(), *new_parent_children)
 
-        self.log_console("Moved '%s' into '%s'" % (item.full_name(), new_parent.full_name()))
+        for item in moved:
+            self.log_console("Moved '%s' into '%s'" % (item.full_name(), new_parent.full_name()))
 
     #
     # Copy, Paste, Cut
@@ -738,8 +750,8 @@ class FileExplorer(object):
                     text= " " + name,
                     image=self._create_tree_icon("document_upload"))
 
-                with open(clipboard, "rb") as f:
-                    data = f.read()
+                # Streamed from disk while uploading
+                data = clipboard
 
             elif is_url(path):
                 try:
@@ -771,10 +783,18 @@ class FileExplorer(object):
             self.log_console("Upload document %s..." % name)
 
             # Upload
+            progress = {"percent": 0}
+            def progress_listener(sent, total):
+                percent = 100 * sent // max(1, total)
+                if percent >= progress["percent"] + 10:
+                    progress["percent"] = percent
+                    self.log_console("Upload %s... %d%%" % (name, percent))
+
             item = self.item_manager.upload_file(
                 id, parent_id, name,
                 filetype, data,
-                self._update_tree_item)
+                self._update_tree_item,
+                progress_listener)
             self.log_console("Successfully uploaded %s" % item.full_name())
 
         for path in paths:
@@ -802,6 +822,8 @@ class FileExplorer(object):
         items = [self.item_manager.get_item(id) for id in selected_ids]
 
         def run():
-            for item in items:
-                item.set_bookmarked(not item.bookmarked())
+            changes = [(item, {"Bookmarked": not item.bookmarked()}) for item in items]
+            failed = self.item_manager.update_items(changes)
+            for item, message in failed:
+                self.log_console("(Error) Could not bookmark '%s' (%s)" % (item.name(), message))
         threading.Thread(target=run).start()
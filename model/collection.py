@@ -36,7 +36,7 @@ class Collection(Item):
 
         # Write metadata of collection and of all parents to ensure 
         # that we have the same information available when we are offline
-        self._write_remapy_file()
+        self._write_local_metadata()
         self.parent().sync()
 
 
@@ -89,13 +89,12 @@ class Collection(Item):
     
 
     def is_parent_of(self, item):
-        for child in self._children:
-            if child.id() == item.id():
-                return True
-            
-            if child.is_parent_of(item):
+        parent = item.parent()
+        while parent is not None:
+            if parent.id() == self.id():
                 return True
-        
+            parent = parent.parent()
+
         return False
     
 
@@ -8,13 +8,16 @@ import datetime
 from time import gmtime, strftime
 import json
 
+from pdfrw import PdfReader
 
 from api.remarkable_client import RemarkableClient
 from utils.helper import Singleton
 import model.render as render
+import model.raster as raster
 import model.item
 from model.item import Item
 from model.collection import Collection
+from model.local_store import LocalStore
 import utils.config as cfg
 
 
@@ -51,12 +54,15 @@ class Document(Item):
         self.path_original_pdf = "%s/%s.pdf" % (self.path, self.id())
         self.path_original_epub = "%s/%s.epub" % (self.path, self.id())
         self.path_highlighter = "%s/%s.highlights/" % (self.path, self.id())
+        self.path_overlay_cache = "%s/overlays" % self.path_remapy
+        self.path_thumbnail_cache = "%s/thumbnails" % self.path_remapy
+        self.path_manifest = "%s/manifest.json" % self.path_remapy
 
         # Other props
         self.download_url = None
-        self.blob_url = None
         self.state = None       # Synced, out of sync etc.
         self.type = None        # Unknown (not downloaded yet), pdf, epub or notebook
+        self.base_pdf = None    # (mtime, PdfReader) of the original pdf for thumbnails
 
         # Set correct state of document
         self._update_state()
@@ -150,12 +156,63 @@ class Document(Item):
             return self.path_original_pdf
 
 
+    def thumbnail(self, page_nr, max_size=raster.THUMBNAIL_SIZE):
+        """ Returns a preview image of the annotations of the given page
+            or None if the page is not annotated.
+        """
+        rm_file_name = "%s/%d" % (self.path_rm_files, page_nr)
+        if not os.path.exists("%s.rm" % rm_file_name):
+            return None
+
+        pages = self.get_pages()
+        page_file = None
+        if page_nr < len(pages):
+            page_file = os.path.join(self.path_highlighter, "%s.json" % pages[page_nr])
+
+        if self.type in (TYPE_PDF, TYPE_EPUB):
+            # Same layout as used by render.pdf for this page
+            page_layout = self._get_pdf_page_layout(page_nr)
+            if page_layout is None:
+                return None
+        else:
+            page_layout = render.PDFPageLayout(is_landscape=self.is_landscape())
+
+        return raster.thumbnail(
+            rm_file_name,
+            page_layout,
+            max_size,
+            page_file=page_file,
+            path_cache=self.path_thumbnail_cache)
+
+
+    def _get_pdf_page_layout(self, page_nr):
+        """ Layout of a page of the original pdf (also for epubs) or None
+            if the page does not exist. The pdf is parsed once and again
+            only if it changed.
+        """
+        try:
+            mtime = os.path.getmtime(self.path_original_pdf)
+        except OSError:
+            return None
+
+        if self.base_pdf is None or self.base_pdf[0] != mtime:
+            self.base_pdf = (mtime, PdfReader(self.path_original_pdf))
+
+        base_pdf = self.base_pdf[1]
+        if page_nr >= base_pdf.numPages:
+            return None
+
+        page_layout = render.get_page_layout(base_pdf, page_nr)
+        return None if page_layout.layout is None else page_layout
+
+
     #
     # Functions
     #
     def delete_local(self):
         if os.path.exists(self.path):
             shutil.rmtree(self.path)
+        LocalStore().delete([self.id()])
         self._update_state()
 
 
@@ -169,28 +226,73 @@ class Document(Item):
 
 
     def sync(self):
+        changed_files = self.download()
+        if changed_files is not None:
+            self.render_annotations(changed_files)
+
+
+    def download(self):
+        """ First step of sync (network): Download and extract the
+            document. Returns the changed files or None if the document
+            is already syncing. The document stays in the syncing state
+            until render_annotations is called.
+        """
         if self.state == model.item.STATE_SYNCING:
-            return
+            return None
 
         self.state = model.item.STATE_SYNCING
         self._update_state_listener()
 
-        self._download_raw()
-        self._write_remapy_file()
+        try:
+            changed_files = self._download_raw()
+            self._write_local_metadata()
+        except Exception as e:
+            self._update_state()
+            raise e
+
         self._update_state(inform_listener=False)
+        self.state = model.item.STATE_SYNCING
+        return changed_files
+
 
+    def render_annotations(self, changed_files=None):
+        """ Second step of sync (cpu): Render the annotated pdfs of the
+            downloaded document. If changed_files is None, everything is
+            rendered.
+        """
+        try:
+            self._render_annotations(changed_files)
+        finally:
+            self._update_state()
+        self.parent().sync()
+
+
+    def _render_annotations(self, changed_files):
         annotations_exist = os.path.exists(self.path_rm_files)
 
-        if self.type == TYPE_NOTEBOOK and annotations_exist:
-            render.notebook(
-                self.path,
-                self.id(),
-                self.path_annotated_pdf,
-                self.is_landscape(),
-                path_templates=cfg.get("general.templates"))
+        # Nothing to render if no file changed (e.g. only the name changed)
+        outputs = [self.path_annotated_pdf]
+        if self.type != TYPE_NOTEBOOK:
+            outputs.append(self.path_oap_pdf)
+        is_rendered = all(os.path.exists(output) for output in outputs)
+
+        if not annotations_exist:
+            for output in outputs:
+                if os.path.exists(output):
+                    os.remove(output)
+
+        elif changed_files is None or len(changed_files) > 0 or not is_rendered:
+            if self.type == TYPE_NOTEBOOK:
+                render.notebook(
+                    self.path,
+                    self.id(),
+                    self.path_annotated_pdf,
+                    self.is_landscape(),
+                    path_templates=cfg.get("general.templates"),
+                    path_cache=self.path_overlay_cache,
+                    changed_files=changed_files)
 
-        else:
-            if annotations_exist:
+            else:
                 # Also for epubs a pdf file exists which we can annotate :)
                 # We will then show the pdf rather than the epub...
                 render.pdf(
@@ -199,32 +301,107 @@ class Document(Item):
                     self.get_pages(),
                     self.path_original_pdf,
                     self.path_annotated_pdf,
-                    self.path_oap_pdf)
-
-        self._update_state()
-        self.parent().sync()
+                    self.path_oap_pdf,
+                    path_cache=self.path_overlay_cache,
+                    changed_files=changed_files,
+                    report_memory=cfg.get("debug.render_memory", False))
 
 
     def _download_raw(self, path=None):
+        """ Download the document and extract only the files that changed
+            since the last sync. Returns the paths of all files that were
+            written or deleted.
+        """
         path = self.path if path == None else path
 
-        if os.path.exists(path):
-            shutil.rmtree(path)
+        blob_url = self.rm_client.get_blob_url(self.id())
+        if blob_url is None:
+            raise Exception("No download url for document %s (deleted?)" % self.id())
 
-        if self.blob_url == None:
-            self.blob_url = self.rm_client.get_item(self.id())["BlobURLGet"]
+        self.rm_client.get_raw_file(
+            blob_url,
+            self.path_zip,
+            refresh_url=lambda: self.rm_client.refresh_blob_url(self.id()))
 
-        raw_file = self.rm_client.get_raw_file(self.blob_url)
-        with open(self.path_zip, "wb") as out:
-            out.write(raw_file)
+        # Members are extracted in chunks; zipfile checks the size and
+        # CRC of every member and raises BadZipFile if they do not match
+        try:
+            changed_files = self._extract(self.path_zip, path)
+        except zipfile.BadZipFile as e:
+            print("(Error) Corrupt download of document %s" % self.id())
+            raise e
+        finally:
+            os.remove(self.path_zip)
+
+        self.type = self._detect_type()
+        return changed_files
+
+
+    def _extract(self, path_zip, path):
+        """ Compare size and CRC of every member with the manifest of the
+            last extraction and extract only members that changed. Files of
+            members that no longer exist are deleted. Without a manifest
+            all old files are deleted (but the caches are kept) and
+            everything is extracted.
+        """
+        manifest = self._read_manifest()
+        if manifest is None:
+            if os.path.exists(path):
+                self._delete_raw(path)
+            manifest = {}
+
+        changed_files = set()
+        new_manifest = {}
+        with zipfile.ZipFile(path_zip, "r") as zip_ref:
+            for info in zip_ref.infolist():
+                if info.is_dir():
+                    continue
+
+                entry = [info.file_size, info.CRC]
+                new_manifest[info.filename] = entry
+                file = os.path.normpath(os.path.join(path, info.filename))
+                is_unchanged = manifest.get(info.filename) == entry and \
+                    os.path.isfile(file) and os.path.getsize(file) == info.file_size
+                if is_unchanged:
+                    continue
+
+                zip_ref.extract(info, path)
+                changed_files.add(file)
+
+        for name in manifest.keys() - new_manifest.keys():
+            file = os.path.normpath(os.path.join(path, name))
+            if os.path.isfile(file):
+                os.remove(file)
+            changed_files.add(file)
+
+        self._write_manifest(new_manifest)
+        return changed_files
+
+
+    def _read_manifest(self):
+        try:
+            with open(self.path_manifest, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
 
-        with zipfile.ZipFile(self.path_zip, "r") as zip_ref:
-            zip_ref.extractall(path)
 
-        os.remove(self.path_zip)
+    def _write_manifest(self, manifest):
+        Path(self.path_remapy).mkdir(parents=True, exist_ok=True)
+        tmp_path = "%s.tmp" % self.path_manifest
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.path_manifest)
 
-        # Update state
-        self._update_state(inform_listener=False)
+
+    def _delete_raw(self, path):
+        for entry in os.scandir(path):
+            if entry.path == self.path_remapy:
+                for remapy_entry in os.scandir(entry.path):
+                    if remapy_entry.path not in (self.path_overlay_cache, self.path_thumbnail_cache):
+                        _remove(remapy_entry)
+                continue
+            _remove(entry)
 
 
     def update_state(self):
@@ -232,27 +409,22 @@ class Document(Item):
 
 
     def _update_state(self, inform_listener=True):
+        local = LocalStore().get(self.id())
 
         # Not synced
-        if not os.path.exists(self.path_metadata_local):
+        if local is None:
             self.type = TYPE_UNKNOWN
             self.state = STATE_NOT_SYNCED
 
         # If synced get file type
         else:
-            with open(self.path_metadata_local, encoding='utf-8') as f:
-                local_metadata = json.loads(f.read())
-
-            self.state = model.item.STATE_SYNCED if local_metadata["Version"] == self.version() else STATE_OUT_OF_SYNC
-            is_epub = os.path.exists(self.path_original_epub)
-            is_pdf = not is_epub and os.path.exists(self.path_original_pdf)
+            self.state = model.item.STATE_SYNCED if local["version"] == self.version() else STATE_OUT_OF_SYNC
+            self.type = local["type"]
 
-            if is_epub:
-                self.type = TYPE_EPUB
-            elif is_pdf:
-                self.type = TYPE_PDF
-            else:
-                self.type = TYPE_NOTEBOOK
+            # Imported from the metadata.local file of an earlier version
+            if self.type is None:
+                self.type = self._detect_type()
+                LocalStore().set_type(self.id(), self.type)
 
         # Inform listener if needed
         if not inform_listener:
@@ -261,6 +433,14 @@ class Document(Item):
         self._update_state_listener()
 
 
+    def _detect_type(self):
+        if os.path.exists(self.path_original_epub):
+            return TYPE_EPUB
+        if os.path.exists(self.path_original_pdf):
+            return TYPE_PDF
+        return TYPE_NOTEBOOK
+
+
     def create_backup(self, backup_path):
 
         backup_path = "%s/%s" % (backup_path, self.parent().full_name())
@@ -270,3 +450,10 @@ class Document(Item):
         extension = os.path.splitext(file_to_backup)[1]
         file_name = self.name().replace("/", ".") + extension
         shutil.copyfile(file_to_backup, backup_path + "/" + file_name)
+
+
+def _remove(entry):
+    if entry.is_dir(follow_symlinks=False):
+        shutil.rmtree(entry.path)
+    else:
+        os.remove(entry.path)
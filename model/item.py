@@ -1,9 +1,8 @@
 from datetime import datetime
 import time
-from pathlib import Path
-import json
 
 from api.remarkable_client import RemarkableClient
+from model.local_store import LocalStore
 import utils.config
 
 
@@ -28,10 +27,6 @@ def get_path_remapy(id):
     return "%s/.remapy" % get_path(id)
 
 
-def get_path_metadata_local(id):
-    return "%s/metadata.local" % get_path_remapy(id)
-
-
 def now_rfc3339():
     return datetime.utcnow().strftime(RFC3339Nano)
 
@@ -50,7 +45,6 @@ class Item(object):
         self._children = []
         self.path = get_path(self.id())
         self.path_remapy = get_path_remapy(self.id())
-        self.path_metadata_local = get_path_metadata_local(self.id())
 
         self.rm_client = RemarkableClient()
         self.state_listener = []
@@ -133,7 +127,7 @@ class Item(object):
         self.metadata["ModifiedClient"] = now_rfc3339()
         self.metadata["Version"] += 1
         self.rm_client.update_metadata(self.metadata)
-        self._write_remapy_file()
+        self._write_local_metadata()
         self._update_state_listener()
 
 
@@ -145,7 +139,7 @@ class Item(object):
         self.metadata["ModifiedClient"] = now_rfc3339()
         self.metadata["Version"] += 1
         self.rm_client.update_metadata(self.metadata)
-        self._write_remapy_file()
+        self._write_local_metadata()
         self._update_state_listener()
 
 
@@ -158,7 +152,7 @@ class Item(object):
         self.metadata["ModifiedClient"] = now_rfc3339()
         self.metadata["Version"] += 1
         self.rm_client.update_metadata(self.metadata)
-        self._write_remapy_file()
+        self._write_local_metadata()
         self._update_state_listener()
 
 
@@ -171,10 +165,8 @@ class Item(object):
             listener(self)
         
 
-    def _write_remapy_file(self):
+    def _write_local_metadata(self):
         if self.is_root():
-            return 
+            return
 
-        Path(self.path_remapy).mkdir(parents=True, exist_ok=True)
-        with open(self.path_metadata_local, "w") as out:
-            out.write(json.dumps(self.metadata, indent=4))
\ No newline at end of file
+        LocalStore().put([self])
\ No newline at end of file
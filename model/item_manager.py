@@ -1,18 +1,36 @@
 import os
 import shutil
 import json 
-from io import BytesIO
+import tempfile
+import threading
 import zipfile
+from datetime import datetime
+from uuid import uuid4
 from zipfile import ZipFile
 
+import api.remarkable_client
 from api.remarkable_client import RemarkableClient
 import model.item
 from model.collection import Collection
 from model.document import Document
+from model.local_store import LocalStore
 from utils.helper import Singleton
 import utils.config
 
 
+# Already compressed file types are stored in the zip without compression
+STORED_FILE_TYPES = ["pdf", "epub"]
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Max. number of items per metadata update or delete request
+METADATA_BATCH_SIZE = 100
+
+# Local items that no longer exist online are moved into this directory
+# (inside utils.config.PATH) and deleted in the background
+GARBAGE_DIR = ".garbage"
+
+
 class ItemManager(metaclass=Singleton):
     """ The ItemManager keeps track of all the collections and documents
         that are stored in your rm cloud. Load and create items through 
@@ -26,6 +44,12 @@ class ItemManager(metaclass=Singleton):
         self.root = None
         self.trash = None
 
+        # id -> item for all items of the tree (including root and trash)
+        self.items = {}
+
+        self.reaper = None
+        self.reaper_lock = threading.Lock()
+
 
     def get_root(self, force=False):
         """ Get root node of tree from cache or download it from the rm cloud. 
@@ -39,27 +63,20 @@ class ItemManager(metaclass=Singleton):
         metadata_list, is_online = self._get_metadata_list()
         
         self._clean_local_items(metadata_list)
-        self.root, self.trash = self._create_tree(metadata_list)
+        self.root, self.trash, self.items = self._create_tree(metadata_list)
         return self.root, is_online
 
 
-    def get_item(self, id, item=None):
+    def get_item(self, id):
         """ Get item object for given id. If item metadata is not already
             downloaded, it is downloaded beforehand.
         """
         self.get_root()
-        
-        item = self.root if item is None else item
 
-        if item.id() == id:
-            return item
-        
-        for child in item.children():
-            found = self.get_item(id, child)
-            if found != None:
-                return found
-        
-        return None
+        item = self.items.get(id)
+        if item is None or item.state == model.item.STATE_DELETED:
+            return None
+        return item
 
 
     def create_backup(self, backup_path):
@@ -76,7 +93,12 @@ class ItemManager(metaclass=Singleton):
             collection=False)
     
 
-    def upload_file(self, id, parent_id, name, filetype, data, state_listener=None):
+    def upload_file(self, id, parent_id, name, filetype, data, state_listener=None, progress_listener=None):
+        """ Upload a new document. data is either the content of the file
+            or the path to it. Files are streamed from disk into a temporary
+            zip and from there to the rm cloud. progress_listener(sent, total)
+            is called while uploading.
+        """
         metadata, mf = self._prepare_new_document_zip(
                 id,
                 name, 
@@ -85,11 +107,15 @@ class ItemManager(metaclass=Singleton):
                 parent_id = parent_id)
 
         # Upload file into cloud
-        metadata = self.rm_client.upload(id, metadata, mf)
+        with mf:
+            metadata = self.rm_client.upload(id, metadata, mf, progress_listener)
+        if metadata is None:
+            raise Exception("Upload of %s failed" % name)
 
         # Download again to ensure that metadata is correct
         parent = self.get_item(parent_id)
         item = self._create_item(metadata, parent)
+        self.items[item.id()] = item
 
         if state_listener != None:
             item.add_state_listener(state_listener)
@@ -99,6 +125,131 @@ class ItemManager(metaclass=Singleton):
         return item
 
 
+    def update_items(self, changes):
+        """ Apply metadata changes to many items with a few requests.
+            changes is a list of (item, {key: value}) tuples, e.g.
+            (item, {"Bookmarked": True}). Items are updated locally only
+            if the update succeeded online. Returns a list of
+            (item, message) tuples for all items that failed.
+        """
+        updates = []
+        for item, change in changes:
+            if item.is_trash() or item.is_root():
+                continue
+
+            metadata = dict(item.metadata)
+            metadata.update(change)
+            metadata["ModifiedClient"] = model.item.now_rfc3339()
+            metadata["Version"] += 1
+            updates.append((item, metadata))
+
+        failed = []
+        updated = []
+        for start in range(0, len(updates), METADATA_BATCH_SIZE):
+            batch = updates[start:start+METADATA_BATCH_SIZE]
+            results = self.rm_client.update_metadata_list([metadata for _, metadata in batch])
+            if results is None:
+                failed.extend((item, "Request failed") for item, _ in batch)
+                continue
+
+            results = {result.get("ID"): result for result in results}
+            for item, metadata in batch:
+                result = results.get(item.id(), {})
+                if not result.get("Success", False):
+                    failed.append((item, result.get("Message", "No result")))
+                    continue
+
+                metadata["Version"] = result.get("Version", metadata["Version"])
+                updated.append((item, metadata))
+
+        # Update local tree and metadata once all requests are done
+        for item, metadata in updated:
+            new_parent_id = metadata["Parent"]
+            item.metadata = metadata
+            if item.parent() is not None and item.parent().id() != new_parent_id:
+                self._move_item(item, new_parent_id)
+
+        LocalStore().put([item for item, _ in updated])
+        for item, _ in updated:
+            item._update_state_listener()
+
+        for item, message in failed:
+            print("(Warning) Failed to update %s: %s" % (item.name(), message))
+        return failed
+
+
+    def set_bookmarked(self, items, bookmarked):
+        return self.update_items([(item, {"Bookmarked": bookmarked}) for item in items])
+
+
+    def move(self, items, new_parent):
+        return self.update_items([(item, {"Parent": new_parent.id()}) for item in items])
+
+
+    def delete_items(self, items):
+        """ Delete the given items and everything they contain with a few
+            batch requests. Children are deleted before their parents and
+            collections are kept if one of their children could not be
+            deleted. The tree is updated once at the end; listeners are
+            informed only for the topmost deleted items. Returns the
+            deleted items and a list of (item, message) for failed items.
+        """
+        # Collect subtrees and sort by height such that children come first.
+        # traverse_tree visits children before their parent.
+        heights = {}
+        def collect(item):
+            height = max([heights[child.id()][1] + 1 for child in item.children()], default=0)
+            heights[item.id()] = (item, height)
+
+        for item in items:
+            if item.id() not in heights:
+                self.traverse_tree(fun=collect, item=item)
+
+        levels = {}
+        for item, height in heights.values():
+            if item.is_trash() or item.is_root():
+                continue
+            levels.setdefault(height, []).append(item)
+
+        deleted = []
+        failed = []
+        failed_ids = set()
+        for height in sorted(levels.keys()):
+            level = []
+            for item in levels[height]:
+                if any(child.id() in failed_ids for child in item.children()):
+                    failed.append((item, "Child could not be deleted"))
+                    failed_ids.add(item.id())
+                else:
+                    level.append(item)
+
+            for start in range(0, len(level), METADATA_BATCH_SIZE):
+                batch = level[start:start+METADATA_BATCH_SIZE]
+                results = self.rm_client.delete_items([{"ID": item.id(), "Version": item.version()} for item in batch])
+                results = {} if results is None else {result.get("ID"): result for result in results}
+                for item in batch:
+                    result = results.get(item.id(), {"Message": "Request failed"})
+                    if result.get("Success", False):
+                        deleted.append(item)
+                    else:
+                        failed.append((item, result.get("Message", "No result")))
+                        failed_ids.add(item.id())
+
+        # Update tree and local store once
+        deleted_ids = set(item.id() for item in deleted)
+        LocalStore().delete(deleted_ids)
+        for item in deleted:
+            item.state = model.item.STATE_DELETED
+            self.items.pop(item.id(), None)
+            if item.parent().id() in deleted_ids:
+                continue
+            item._update_state_listener()
+
+        for item, message in failed:
+            print("(Warning) Failed to delete %s: %s" % (item.name(), message))
+        return deleted, failed
+
+
     def traverse_tree(self, fun, item=None, document=True, collection=True):
         """ Traverse item tree (bottom up) and call fun for item depending on 
             whether document=True and colleciton=True.
@@ -112,6 +263,21 @@ class ItemManager(metaclass=Singleton):
             fun(item)
 
 
+    def _move_item(self, item, new_parent_id):
+        old_parent = item.parent()
+        new_parent = self.root if new_parent_id == "" else self.get_item(new_parent_id)
+        if new_parent is None:
+            return
+
+        if item in old_parent.children():
+            old_parent.children().remove(item)
+        if old_parent.listen_child_state_change in item.state_listener:
+            item.state_listener.remove(old_parent.listen_child_state_change)
+
+        item._parent = new_parent
+        new_parent.add_child(item)
+
+
     def _create_item(self, metadata, parent):
         if metadata["Type"] == "CollectionType":
             new_object = Collection(metadata, parent)
@@ -128,33 +294,103 @@ class ItemManager(metaclass=Singleton):
         
     def _get_metadata_list(self):
         try:
-            metadata_list = self.rm_client.list_items()
+            # Download urls are fetched in the same request such that
+            # documents can be synced without another request per document
+            metadata_list = self.rm_client.list_items(with_blob=True)
             return metadata_list, metadata_list != None
         except:
-            metadata_list = []
-            for local_id in os.listdir(utils.config.PATH):
-                metadata_path = model.item.get_path_metadata_local(local_id)
-                with open(metadata_path, 'r') as file:
-                    metadata_content = file.read().replace('\n', '')
-                
-                metadata = json.loads(metadata_content)
-                metadata_list.append(metadata)
+            # Offline the tree is created from the local store
+            metadata_list = LocalStore().metadata_list()
 
         return metadata_list, False
 
 
     def _clean_local_items(self, metadata_list):
-        online_ids = [metadata["ID"] for metadata in metadata_list]
-        for local_id in os.listdir(utils.config.PATH):
-            if local_id in online_ids:
-                continue
-            
-            local_file_or_folder = "%s/%s" % (utils.config.PATH, local_id)
-            if os.path.isfile(local_file_or_folder):
-                os.remove(local_file_or_folder)
-            else:
-                shutil.rmtree(local_file_or_folder)
-            print("Deleted local item %s" % local_id)
+        """ Remove local items that do not exist online anymore. They are
+            only renamed into the garbage directory here; the files are
+            deleted by a background thread such that the tree can be
+            created right away.
+        """
+        online_ids = set(metadata["ID"] for metadata in metadata_list)
+        garbage_path = os.path.join(utils.config.PATH, GARBAGE_DIR)
+        LocalStore().retain(online_ids)
+
+        # Entries that start with a dot (garbage, partial downloads, local
+        # store) are no items
+        with os.scandir(utils.config.PATH) as entries:
+            stale = [entry.path for entry in entries
+                if entry.name not in online_ids and not entry.name.startswith(".")]
+
+        # Unfinished downloads (<id>.zip.part) are kept to be resumed
+        # unless the document does not exist anymore
+        partial_path = os.path.join(utils.config.PATH, api.remarkable_client.PARTIAL_DIR)
+        if os.path.isdir(partial_path):
+            with os.scandir(partial_path) as entries:
+                stale.extend(entry.path for entry in entries
+                    if entry.name.split(".")[0] not in online_ids)
+
+        if len(stale) > 0:
+            os.makedirs(garbage_path, exist_ok=True)
+
+        for path in stale:
+            # Unique name in case the same id was removed before and is
+            # not reaped yet
+            local_id = os.path.basename(path)
+            target = os.path.join(garbage_path, "%s.%s" % (local_id, uuid4()))
+            try:
+                os.replace(path, target)
+                print("Deleted local item %s" % local_id)
+            except OSError as e:
+                print("(Warning) Failed to delete local item %s" % local_id)
+                print(e)
+
+        # Also reap garbage that is left over from earlier runs
+        if os.path.isdir(garbage_path):
+            self._start_reaper(garbage_path)
+
+
+    def _start_reaper(self, garbage_path):
+        with self.reaper_lock:
+            if self.reaper is not None:
+                return
+
+            self.reaper = threading.Thread(target=self._reap, args=(garbage_path,), daemon=True)
+            self.reaper.start()
+
+
+    def _reap(self, garbage_path):
+        """ Delete everything in the garbage directory until it is empty
+            (or nothing can be deleted anymore).
+        """
+        while True:
+            with self.reaper_lock:
+                try:
+                    with os.scandir(garbage_path) as entries:
+                        garbage = [(entry.path, entry.is_dir(follow_symlinks=False)) for entry in entries]
+                except OSError:
+                    garbage = []
+
+                if len(garbage) <= 0:
+                    self.reaper = None
+                    return
+
+            removed = 0
+            for path, is_dir in garbage:
+                try:
+                    if is_dir:
+                        shutil.rmtree(path)
+                    else:
+                        os.remove(path)
+                    removed += 1
+                except OSError as e:
+                    print("(Warning) Failed to remove %s" % path)
+                    print(e)
+
+            # Retried with the next start
+            if removed <= 0:
+                with self.reaper_lock:
+                    self.reaper = None
+                return
 
 
     def _create_tree(self, metadata_list):
@@ -190,7 +426,7 @@ class ItemManager(metaclass=Singleton):
         for i in range(len(metadata_list)):
             self._create_item_and_parents(i, metadata_list, items, lookup_table)
 
-        return root, trash
+        return root, trash, items
 
 
     def _create_item_and_parents(self, i, metadata_list, items, lookup_table):
@@ -214,6 +450,9 @@ class ItemManager(metaclass=Singleton):
 
 
     def _prepare_new_document_zip(self, id, name, data, file_type, parent_id=""):
+        """ Create the zip of a new document in a temporary file. data is
+            either the content or the path of the document.
+        """
 
         # .content file
         content_file = json.dumps({
@@ -274,16 +513,24 @@ class ItemManager(metaclass=Singleton):
             # "BlobURLPutExpires": ""
         }
 
-        mf = BytesIO()
-        mf.seek(0)
+        # The zip is written into a temporary file (deleted on close) and
+        # the document is copied in chunks, such that large files are
+        # never loaded into memory
+        mf = tempfile.TemporaryFile()
         with ZipFile(mf, mode='w', compression=zipfile.ZIP_DEFLATED ) as zf:
-            zf.writestr("%s.%s" % (id, file_type), data)
+            compress_type = zipfile.ZIP_STORED if file_type in STORED_FILE_TYPES else zipfile.ZIP_DEFLATED
+            info = zipfile.ZipInfo("%s.%s" % (id, file_type), date_time=datetime.now().timetuple()[:6])
+            info.compress_type = compress_type
+
+            if isinstance(data, (bytes, bytearray)):
+                zf.writestr(info, data)
+            else:
+                force_zip64 = os.path.getsize(data) >= zipfile.ZIP64_LIMIT
+                with open(data, "rb") as src, zf.open(info, "w", force_zip64=force_zip64) as dst:
+                    shutil.copyfileobj(src, dst, UPLOAD_CHUNK_SIZE)
+
             zf.writestr("%s.content" % id, content_file)
             zf.writestr("%s.pagedata" % id, "")
 
-        # with open("test.zip", "wb") as f:
-        #     f.write(mf.getvalue())
         mf.seek(0)
         return metadata, mf
-
-
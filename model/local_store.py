@@ -0,0 +1,168 @@
+import json
+import os
+import sqlite3
+import threading
+
+from utils.helper import Singleton
+import utils.config
+
+
+#
+# DEFINITIONS
+#
+# The database is stored in the data directory. Item ids never start
+# with a dot, so the file (and the -wal/-shm files) are not mistaken
+# for items.
+FILE_NAME = ".remapy.sqlite"
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS items (
+        id TEXT PRIMARY KEY,
+        metadata TEXT NOT NULL,
+        version INTEGER NOT NULL,
+        type INTEGER
+    )
+"""
+
+
+class LocalStore(metaclass=Singleton):
+    """ Stores the metadata, the synced version and the document type of
+        all local items in a single sqlite database. All rows are loaded
+        into memory when the store is opened, such that the tree can be
+        created (online and offline) with a single read. Every write is
+        one transaction.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.connection = None
+        self.entries = {}
+
+
+    def get(self, id):
+        """ Returns {"metadata": ..., "version": ..., "type": ...} of the
+            local item or None if the item is not stored locally. type is
+            None for collections and for documents whose type is not
+            known yet.
+        """
+        with self.lock:
+            self._connect()
+            return self.entries.get(id)
+
+
+    def metadata_list(self):
+        with self.lock:
+            self._connect()
+            return [dict(entry["metadata"]) for entry in self.entries.values()]
+
+
+    def put(self, items):
+        """ Store the current metadata (and the type of documents) of all
+            given items.
+        """
+        rows = []
+        for item in items:
+            if item.is_root():
+                continue
+            type = item.type if item.is_document() else None
+            rows.append((item.id(), dict(item.metadata), item.version(), type))
+
+        with self.lock:
+            connection = self._connect()
+            with connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO items (id, metadata, version, type) VALUES (?, ?, ?, ?)",
+                    [(id, json.dumps(metadata), version, type) for id, metadata, version, type in rows])
+
+            for id, metadata, version, type in rows:
+                self.entries[id] = {"metadata": metadata, "version": version, "type": type}
+
+
+    def set_type(self, id, type):
+        with self.lock:
+            connection = self._connect()
+            if id not in self.entries:
+                return
+
+            with connection:
+                connection.execute("UPDATE items SET type = ? WHERE id = ?", (type, id))
+            self.entries[id]["type"] = type
+
+
+    def delete(self, ids):
+        with self.lock:
+            connection = self._connect()
+            ids = [id for id in ids if id in self.entries]
+            if len(ids) <= 0:
+                return
+
+            with connection:
+                connection.executemany("DELETE FROM items WHERE id = ?", [(id,) for id in ids])
+            for id in ids:
+                del self.entries[id]
+
+
+    def retain(self, ids):
+        """ Delete all items that are not in ids.
+        """
+        with self.lock:
+            self._connect()
+            ids = set(ids)
+            self.delete([id for id in self.entries.keys() if id not in ids])
+
+
+    def close(self):
+        """ Close the database (e.g. before the data directory is
+            deleted). It is opened again with the next access.
+        """
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+            self.connection = None
+            self.entries = {}
+
+
+    def _connect(self):
+        if self.connection is not None:
+            return self.connection
+
+        os.makedirs(utils.config.PATH, exist_ok=True)
+        path = os.path.join(utils.config.PATH, FILE_NAME)
+        is_new = not os.path.exists(path)
+
+        connection = sqlite3.connect(path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        with connection:
+            connection.execute(SCHEMA)
+            if is_new:
+                _import_local_files(connection)
+
+        self.entries = {}
+        for id, metadata, version, type in connection.execute("SELECT id, metadata, version, type FROM items"):
+            self.entries[id] = {"metadata": json.loads(metadata), "version": version, "type": type}
+
+        self.connection = connection
+        return connection
+
+
+def _import_local_files(connection):
+    """ Import the metadata.local files of earlier versions. The type of
+        documents is detected when they are loaded the first time.
+    """
+    rows = []
+    with os.scandir(utils.config.PATH) as entries:
+        for entry in entries:
+            if entry.name.startswith(".") or not entry.is_dir():
+                continue
+
+            path = os.path.join(entry.path, ".remapy", "metadata.local")
+            try:
+                with open(path, encoding="utf-8") as f:
+                    metadata = json.load(f)
+            except (OSError, ValueError):
+                continue
+            rows.append((metadata["ID"], json.dumps(metadata), metadata["Version"], None))
+
+    connection.executemany(
+        "INSERT OR REPLACE INTO items (id, metadata, version, type) VALUES (?, ?, ?, ?)", rows)
@@ -0,0 +1,90 @@
+import hashlib
+import os
+from pathlib import Path
+
+
+# Default max. size of the cache of a single document in bytes
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+
+
+class OverlayCache(object):
+    """ Persistent cache of rendered page overlays. Every overlay is stored
+        in its own file named by a hash of all inputs that were used to
+        render it. If the cache grows larger than max_size, the least
+        recently used overlays are deleted. The cache is also used for
+        other rendered files (e.g. png thumbnails), see extension.
+    """
+
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE, extension="pdf"):
+        self.path = path
+        self.max_size = max_size
+        self.extension = extension
+
+
+    def key(self, files, extra=""):
+        """ Create a key from the content of the given files and some extra
+            information (e.g. the page layout). Files that do not exist are
+            also part of the key.
+        """
+        h = hashlib.sha1()
+        for file in files:
+            h.update(str(file).encode("utf-8"))
+            if file is None or not os.path.exists(file):
+                h.update(b"\0")
+                continue
+
+            with open(file, "rb") as f:
+                h.update(f.read())
+        h.update(str(extra).encode("utf-8"))
+        return h.hexdigest()
+
+
+    def get(self, key):
+        path = self._get_path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+
+        # Mark as recently used
+        os.utime(path)
+        return data
+
+
+    def put(self, key, data):
+        Path(self.path).mkdir(parents=True, exist_ok=True)
+        path = self._get_path(key)
+        tmp_path = "%s.tmp" % path
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+
+    def evict(self):
+        """ Delete least recently used overlays until the cache is smaller
+            than max_size.
+        """
+        if not os.path.exists(self.path):
+            return
+
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        size = sum(e[1] for e in entries)
+        for _, entry_size, entry_path in sorted(entries):
+            if size <= self.max_size:
+                break
+
+            try:
+                os.remove(entry_path)
+                size -= entry_size
+            except OSError:
+                pass
+
+
+    def _get_path(self, key):
+        return os.path.join(self.path, "%s.%s" % (key, self.extension))
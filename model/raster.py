@@ -0,0 +1,173 @@
+import io
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+import model.render as render
+import model.rm_file as rm_file_parser
+from model.overlay_cache import OverlayCache
+
+
+#
+# DEFINITIONS
+#
+# Max. width or height of a thumbnail in pixels
+THUMBNAIL_SIZE = 256
+
+# Thumbnails are rendered with a higher resolution and scaled down
+# afterwards to get smooth lines
+THUMBNAIL_SUPERSAMPLING = 2
+
+# Increase if the output of the raster renderer changes
+RASTER_VERSION = 1
+
+
+#
+# API
+#
+def page(rm_file_name, page_layout=None, zoom=1.0, page_file=None, background=None):
+    """ Render the strokes of the given .rm file into an RGB image. The
+        page_layout defines the geometry (as for the pdf renderer) and one
+        pdf point is drawn as zoom pixels. If background is given (an image),
+        strokes are drawn on top of it; otherwise on a white page.
+    """
+    page_layout = render.PDFPageLayout() if page_layout is None else page_layout
+    size = (
+        max(1, int(round((page_layout.x_end - page_layout.x_start) * zoom))),
+        max(1, int(round((page_layout.y_end - page_layout.y_start) * zoom))))
+
+    if background is None:
+        image = Image.new("RGB", size, "white")
+    else:
+        image = background.convert("RGB").resize(size)
+
+    rm_page = rm_file_parser.read("%s.rm" % rm_file_name)
+    layer_colors = render._get_layer_colors("%s-metadata.json" % rm_file_name, rm_page.num_layers())
+
+    for layer in range(rm_page.num_layers()):
+        for stroke in rm_page.layers[layer]:
+            pen = render._get_pen(stroke.pen_nr, stroke.width, stroke.color, page_layout.scale)
+            if pen is None or isinstance(pen, (render.Eraser, render.EraseArea)):
+                continue
+            _draw_stroke(image, stroke, pen, layer_colors[layer], page_layout, zoom)
+
+    for x, y, width, height in render._get_highlights(page_file, page_layout):
+        points = [_to_pixel(x, y, page_layout, zoom), _to_pixel(x + width, y, page_layout, zoom)]
+        _draw_translucent(image, points, render.default_stroke_color[3], _to_width(height, zoom), 0.2)
+
+    return image
+
+
+def thumbnail(rm_file_name, page_layout=None, max_size=THUMBNAIL_SIZE, page_file=None, path_cache=None):
+    """ Render a small preview of the given .rm file whose width and height
+        are at most max_size pixels. If path_cache is given, thumbnails are
+        stored there and only rendered again if the page changed.
+    """
+    page_layout = render.PDFPageLayout() if page_layout is None else page_layout
+    cache = OverlayCache(path_cache, extension="png") if path_cache is not None else None
+
+    if cache is not None:
+        files = ["%s.rm" % rm_file_name, "%s-metadata.json" % rm_file_name, page_file]
+        key = cache.key(files, (RASTER_VERSION, page_layout.layout, max_size))
+        data = cache.get(key)
+        if data is not None:
+            return Image.open(io.BytesIO(data))
+
+    zoom = max_size / max(page_layout.x_end - page_layout.x_start, page_layout.y_end - page_layout.y_start)
+    image = page(rm_file_name, page_layout, zoom * THUMBNAIL_SUPERSAMPLING, page_file)
+    image.thumbnail((max_size, max_size), Image.LANCZOS)
+
+    if cache is not None:
+        data = io.BytesIO()
+        image.save(data, format="PNG", optimize=True)
+        cache.put(key, data.getvalue())
+        cache.evict()
+
+    return image
+
+
+def contact_sheet(images, columns=8, padding=8, background="white"):
+    """ Arrange the given images (e.g. thumbnails) in a grid.
+    """
+    if len(images) <= 0:
+        return None
+
+    cell_width = max(image.width for image in images)
+    cell_height = max(image.height for image in images)
+    rows = (len(images) + columns - 1) // columns
+    sheet = Image.new(
+        "RGB",
+        (columns * (cell_width + padding) + padding, rows * (cell_height + padding) + padding),
+        background)
+
+    for i, image in enumerate(images):
+        x = padding + (i % columns) * (cell_width + padding)
+        y = padding + (i // columns) * (cell_height + padding)
+        sheet.paste(image, (x, y))
+    return sheet
+
+
+#
+# HELPER
+#
+def _draw_stroke(image, stroke, pen, layer_color, page_layout, zoom):
+    segments = stroke.segments
+    if len(segments) < 2:
+        return
+
+    xs, ys = render._get_stroke_points(segments, page_layout)
+    xs = (xs - page_layout.x_start) * zoom
+    ys = (page_layout.y_end - ys) * zoom
+    points = list(zip(xs.tolist(), ys.tolist()))
+
+    speed, tilt, width, pressure = segments["speed"], segments["tilt"], segments["width"], segments["pressure"]
+    widths = pen.get_stroke_widths(speed, tilt, width, pressure)
+    widths = np.maximum(1, np.rint(widths * zoom)).astype(int).tolist()
+    opacities = pen.get_stroke_opacities(speed, tilt, width, pressure).tolist()
+    if layer_color is None:
+        colors = render._get_colors(pen.get_stroke_colors(speed, tilt, width, pressure))
+    else:
+        colors = [layer_color] * len(segments)
+
+    # Pixel widths are integers, so runs are built on the rounded widths
+    for start, end in render._get_style_runs(widths, opacities, colors, 0):
+        color = colors[start]
+        opacity = opacities[start] * getattr(color, "alpha", 1)
+        run = points[start - 1:end]
+        if opacity >= 1:
+            draw = ImageDraw.Draw(image)
+            draw.line(run, fill=_to_rgb(color.rgb()), width=widths[start], joint="curve")
+        elif opacity > 0:
+            _draw_translucent(image, run, color.rgb(), widths[start], opacity)
+
+
+def _draw_translucent(image, points, color, width, opacity):
+    """ Draw a translucent polyline. The line is drawn into a mask that
+        covers only its bounding box, such that overlapping segments of
+        the same line are not blended twice.
+    """
+    xs = [p[0] for p in points]
+    ys = [p[1] for p in points]
+    left = max(0, int(min(xs) - width))
+    top = max(0, int(min(ys) - width))
+    right = min(image.width, int(max(xs) + width) + 1)
+    bottom = min(image.height, int(max(ys) + width) + 1)
+    if right <= left or bottom <= top:
+        return
+
+    mask = Image.new("L", (right - left, bottom - top), 0)
+    draw = ImageDraw.Draw(mask)
+    draw.line([(x - left, y - top) for x, y in points], fill=int(round(opacity * 255)), width=width, joint="curve")
+    image.paste(_to_rgb(color), (left, top, right, bottom), mask)
+
+
+def _to_pixel(x, y, page_layout, zoom):
+    return ((x - page_layout.x_start) * zoom, (page_layout.y_end - y) * zoom)
+
+
+def _to_width(width, zoom):
+    return max(1, int(round(width * zoom)))
+
+
+def _to_rgb(color):
+    return tuple(int(round(255 * c)) for c in color[:3])
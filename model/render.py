@@ -1,18 +1,49 @@
+import functools
 import io
 import json
+import multiprocessing
 import os
 import os.path
 import re
-import struct
+import threading
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from uuid import uuid4
 
+import numpy as np
 from pdfrw import PdfReader, PdfWriter, PageMerge
 from reportlab.lib import colors
 from reportlab.pdfgen import canvas
 
+import model.rm_file as rm_file_parser
+from model.overlay_cache import OverlayCache
+
 # Size
 DEFAULT_IMAGE_WIDTH = 1404
 DEFAULT_IMAGE_HEIGHT = 1872
 
+# Max. difference of width and opacity such that segments are still
+# merged into a single path while rendering
+STYLE_TOLERANCE = 0.0
+
+# Pages are rendered in a process pool with RENDER_WORKERS processes if
+# at least PARALLEL_MIN_PAGES pages are annotated. For smaller documents
+# the start-up of the pool costs more than it saves.
+RENDER_WORKERS = os.cpu_count() or 1
+PARALLEL_MIN_PAGES = 8
+
+# Number of pages that are rendered at once by pdf(). The overlay readers
+# of a chunk are merged and released before the next chunk is rendered.
+RENDER_CHUNK_SIZE = 64
+
+# Number of converted templates that are kept in memory
+TEMPLATE_CACHE_SIZE = 32
+
+# Increase if the output of the renderer changes such that cached
+# overlays are rendered again
+RENDER_VERSION = 1
+
 # Mappings
 default_stroke_color = {
     0: (48 / 255., 63 / 255., 159 / 255.),        # Pen color 1
@@ -68,64 +99,89 @@ class PDFPageLayout:
             return "PDFPageLayout: None"
 
 
-def pdf(rm_files_path, path_highlighter, pages, path_original_pdf, path_annotated_pdf, path_oap_pdf):
+def pdf(rm_files_path, path_highlighter, pages, path_original_pdf, path_annotated_pdf, path_oap_pdf,
+        style_tolerance=STYLE_TOLERANCE, max_workers=RENDER_WORKERS, path_cache=None, changed_files=None,
+        report_memory=False):
     """ Render pdf with annotations. The path_oap_pdf defines the pdf
-        which includes only annotated pages.
+        which includes only annotated pages. If path_cache is given,
+        overlays of pages that did not change are reused from there.
+        changed_files (if known) are the files changed since the last
+        rendering; pages that use one of them are rendered directly.
+        Pages are rendered in chunks and every overlay is merged into its
+        page as soon as it is available, such that only the readers of one
+        chunk are kept. Note that the merged pages (including their overlay
+        content) are referenced by the base pdf until both outputs are
+        written, as pdfrw can not write pages incrementally. Memory
+        therefore still grows with the number of annotated pages.
+        If report_memory is set, the peak memory of this render is
+        printed (see _start_memory_trace).
     """
+    if report_memory:
+        _start_memory_trace()
 
-    base_pdf = PdfReader(open(path_original_pdf, "rb"))
+    base_pdf = PdfReader(path_original_pdf)
 
     # Parse remarkable files and write into pdf
-    annotations_pdf = []
+    jobs = []
+    page_nrs = []
 
     for page_nr in range(base_pdf.numPages):
         rm_file_name = "%s/%d" % (rm_files_path, page_nr)
         rm_file = "%s.rm" % rm_file_name
         if not os.path.exists(rm_file):
-            annotations_pdf.append(None)
             continue
 
-        if hasattr(base_pdf, "Root") and hasattr(base_pdf.Root, "Pages") and hasattr(base_pdf.Root.Pages, "MediaBox"):
-            default_layout = base_pdf.Root.Pages.MediaBox
-        else:
-            default_layout = None
-        page_layout = PDFPageLayout(base_pdf.pages[page_nr], default_layout=default_layout)
+        page_layout = get_page_layout(base_pdf, page_nr)
         if page_layout.layout is None:
-            annotations_pdf.append(None)
             continue
 
         page_file = os.path.join(path_highlighter, f"{pages[page_nr]}.json")
-        annotated_page = _render_rm_file(
-            rm_file_name,
-            page_layout=page_layout,
-            page_file=page_file,)
+        jobs.append((rm_file_name, page_layout, page_file, style_tolerance))
+        page_nrs.append(page_nr)
 
+    # Merge annotations pdf and original pdf
+    annotated_page_nrs = set()
+    overlays = _iter_pages(jobs, max_workers, path_cache, changed_files=changed_files)
+    for page_nr, annotated_page in zip(page_nrs, overlays):
         if len(annotated_page.pages) <= 0:
-            annotations_pdf.append(None)
-        else:
-            page = annotated_page.pages[0]
-            annotations_pdf.append(page)
+            continue
+
+        merger = PageMerge(base_pdf.pages[page_nr])
+        merger.add(annotated_page.pages[0]).render()
+        annotated_page_nrs.add(page_nr)
 
-    # Merge annotations pdf and original pdf
     writer_full = PdfWriter()
     writer_oap = PdfWriter()
     for i in range(base_pdf.numPages):
-        annotations_page = annotations_pdf[i]
-
-        if annotations_page is not None:
-            merger = PageMerge(base_pdf.pages[i])
-            merger.add(annotations_page).render()
+        if i in annotated_page_nrs:
             writer_oap.addpage(base_pdf.pages[i])
-
         writer_full.addpage(base_pdf.pages[i])
 
-    writer_full.write(path_annotated_pdf)
-    writer_oap.write(path_oap_pdf)
+    _write_atomic(writer_full, path_annotated_pdf)
+    del writer_full
+    _write_atomic(writer_oap, path_oap_pdf)
+
+    if report_memory:
+        peak_memory = _stop_memory_trace()
+        print("Rendered %d pages of %s (peak memory %.1f MB)" % (
+            len(annotated_page_nrs), path_original_pdf, peak_memory / 1024 / 1024))
 
 
-def notebook(path, uuid, path_annotated_pdf, is_landscape, path_templates=None):
+def get_page_layout(base_pdf, page_nr):
+    """ Layout of the given page of the base pdf (a PdfReader) that is
+        used to render the annotations of this page.
+    """
+    if hasattr(base_pdf, "Root") and hasattr(base_pdf.Root, "Pages") and hasattr(base_pdf.Root.Pages, "MediaBox"):
+        default_layout = base_pdf.Root.Pages.MediaBox
+    else:
+        default_layout = None
+    return PDFPageLayout(base_pdf.pages[page_nr], default_layout=default_layout)
+
+
+def notebook(path, uuid, path_annotated_pdf, is_landscape, path_templates=None,
+             style_tolerance=STYLE_TOLERANCE, max_workers=RENDER_WORKERS, path_cache=None, changed_files=None):
     rm_files_path = "%s/%s" % (path, uuid)
-    annotations_pdf = []
+    jobs = []
 
     p = 0
     while True:
@@ -135,58 +191,247 @@ def notebook(path, uuid, path_annotated_pdf, is_landscape, path_templates=None):
         if not os.path.exists(rm_file):
             break
 
-        overlay = _render_rm_file(rm_file_name, PDFPageLayout(is_landscape=is_landscape))
-        annotations_pdf.append(overlay)
+        jobs.append((rm_file_name, PDFPageLayout(is_landscape=is_landscape), None, style_tolerance))
         p += 1
 
-    # Write empty notebook notes containing blank pages or templates
-    writer = PdfWriter()
+    # Create notebook pages containing blank pages or templates
+    pages = []
     templates = _get_templates_per_page(path, uuid, path_templates)
     for template in templates:
         if template is None:
-            writer.addpage(_blank_page())
+            pages.append(_blank_page())
         else:
-            writer.addpage(template.pages[0])
-    writer.write(path_annotated_pdf)
+            pages.append(_template_page(template))
 
     # Overlay empty notebook with annotations
-    templates_pdf = PdfReader(path_annotated_pdf)
-    for i in range(len(annotations_pdf)):
-        templates_pdf.pages[i].Rotate = 90 if is_landscape else 0
-        is_empty_page = len(annotations_pdf[i].pages) <= 0
+    overlays = _iter_pages(jobs, max_workers, path_cache, changed_files=changed_files)
+    for i, overlay in enumerate(overlays):
+        pages[i].Rotate = 90 if is_landscape else 0
+        is_empty_page = len(overlay.pages) <= 0
         if is_empty_page:
             continue
 
-        annotated_page = annotations_pdf[i].pages[0]
+        annotated_page = overlay.pages[0]
         annotated_page.Rotate = -90 if is_landscape else 0
-        merger = PageMerge(templates_pdf.pages[i])
+        merger = PageMerge(pages[i])
         merger.add(annotated_page).render()
 
     writer = PdfWriter()
-    writer.write(path_annotated_pdf, templates_pdf)
+    for page in pages:
+        writer.addpage(page)
+    _write_atomic(writer, path_annotated_pdf)
+
+
+def _write_atomic(writer, path):
+    """ Write into a temporary file first and rename it afterwards, such
+        that nobody (e.g. a pdf viewer) can open a half written file.
+    """
+    tmp_path = "%s.%s.tmp" % (path, uuid4().hex)
+    try:
+        with open(tmp_path, "wb") as f:
+            writer.write(f)
+        os.replace(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+#
+# Memory report
+#
+_trace_lock = threading.Lock()
+_trace_users = 0
+
+
+def _start_memory_trace():
+    """ Trace the memory allocated by python (tracemalloc) until
+        _stop_memory_trace is called. This works on all platforms but
+        slows rendering down, therefore it is only enabled on request.
+        The render processes are not traced and the peak is process wide,
+        i.e. concurrent renders are included.
+    """
+    global _trace_users
+
+    with _trace_lock:
+        if _trace_users <= 0:
+            tracemalloc.start()
+        _trace_users += 1
+        tracemalloc.reset_peak()
+
+
+def _stop_memory_trace():
+    """ Returns the peak memory (in bytes) since _start_memory_trace.
+    """
+    global _trace_users
+
+    with _trace_lock:
+        _, peak = tracemalloc.get_traced_memory()
+        _trace_users -= 1
+        if _trace_users <= 0:
+            tracemalloc.stop()
+        return peak
+
+
+#
+# Parallel rendering
+#
+# One process pool per pool size (max_workers)
+_executors = {}
+_executor_lock = threading.Lock()
+
+
+def _get_executor(max_workers):
+    """ Process pools are shared by all documents (also if they are
+        synced from different threads) such that they are started only
+        once. Every pool size gets its own pool which is never replaced
+        while it is in use, so every caller gets the number of workers it
+        asked for. The app always uses RENDER_WORKERS, i.e. a single pool.
+        We use spawn rather than fork as the gui runs multiple threads.
+    """
+    with _executor_lock:
+        executor = _executors.get(max_workers)
+        if executor is None:
+            context = multiprocessing.get_context("spawn")
+            executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=context)
+            _executors[max_workers] = executor
+        return executor
+
+
+def _reset_executor(executor):
+    """ Remove a broken pool; the next caller starts a new one.
+    """
+    with _executor_lock:
+        for max_workers, current in list(_executors.items()):
+            if current is executor:
+                del _executors[max_workers]
+    executor.shutdown(wait=False)
+
+
+def _iter_pages(jobs, max_workers=RENDER_WORKERS, path_cache=None, chunk_size=RENDER_CHUNK_SIZE,
+                changed_files=None):
+    """ Same as _render_pages, but renders chunk by chunk and yields the
+        overlays one after another.
+    """
+    for start in range(0, len(jobs), chunk_size):
+        overlays = _render_pages(jobs[start:start+chunk_size], max_workers, path_cache, changed_files)
+        overlays.reverse()
+        while overlays:
+            yield overlays.pop()
+
+
+def _render_pages(jobs, max_workers=RENDER_WORKERS, path_cache=None, changed_files=None):
+    """ Render the given pages (arguments of _render_rm_data) and return
+        the overlays in the same order. Pages found in the cache are not
+        rendered again; pages that use one of the changed_files are not
+        looked up. Large documents are rendered in parallel, small
+        documents sequentially.
+    """
+    data = [None for _ in jobs]
+    keys = [None for _ in jobs]
+    cache = OverlayCache(path_cache) if path_cache is not None else None
+
+    if cache is not None:
+        for i, (rm_file_name, page_layout, page_file, style_tolerance) in enumerate(jobs):
+            files = ["%s.rm" % rm_file_name, "%s-metadata.json" % rm_file_name, page_file]
+            extra = (RENDER_VERSION, page_layout.layout, style_tolerance)
+            keys[i] = cache.key(files, extra)
+            if not _is_changed(files, changed_files):
+                data[i] = cache.get(keys[i])
+
+    missing = [i for i in range(len(jobs)) if data[i] is None]
+    rendered = _render_data(
+        [jobs[i] for i in missing],
+        max_workers)
+
+    for i, page_data in zip(missing, rendered):
+        data[i] = page_data
+        if cache is not None:
+            cache.put(keys[i], page_data)
+
+    if cache is not None and len(missing) > 0:
+        cache.evict()
+
+    return [PdfReader(io.BytesIO(d)) for d in data]
+
+
+def _is_changed(files, changed_files):
+    if changed_files is None:
+        return False
+    return any(file is not None and os.path.normpath(file) in changed_files for file in files)
+
+
+def _render_data(jobs, max_workers):
+    if max_workers is None or max_workers <= 1 or len(jobs) < PARALLEL_MIN_PAGES:
+        return [_render_rm_data(*job) for job in jobs]
+
+    executor = _get_executor(max_workers)
+    try:
+        chunksize = max(1, len(jobs) // (4 * max_workers))
+        return list(executor.map(_render_rm_data, *zip(*jobs), chunksize=chunksize))
+    except BrokenProcessPool:
+        print("(Warning) Render process died. Fallback to sequential rendering.")
+        _reset_executor(executor)
+        return [_render_rm_data(*job) for job in jobs]
+    except RuntimeError as e:
+        # Only if the pool was shut down by another thread (after it
+        # broke); errors of the rendering itself are raised
+        if not _is_shutdown_error(e):
+            raise e
+        print("(Warning) Render pool was shut down. Fallback to sequential rendering.")
+        return [_render_rm_data(*job) for job in jobs]
+
+
+def _is_shutdown_error(error):
+    return str(error).startswith("cannot schedule new futures after")
 
 
 def _get_templates_per_page(path, uuid, path_templates):
+    """ Returns the template page for every page of the notebook or None
+        if no template exists. Pages with the same template share the same
+        page object, such that the image is embedded only once.
+    """
     pagedata_file = "%s/%s.pagedata" % (path, uuid)
     with open(pagedata_file, 'r') as f:
         template_paths = ["%s/%s.png" % (path_templates, l.rstrip('\n')) for l in f]
 
     templates = []
+    template_pages = {}
     for template_path in template_paths:
         if not os.path.exists(template_path):
             templates.append(None)
             continue
 
-        packet = io.BytesIO()
-        can = canvas.Canvas(packet, pagesize=(DEFAULT_IMAGE_WIDTH, DEFAULT_IMAGE_HEIGHT))
-        can.drawImage(template_path, 0, 0)
-        can.save()
-        packet.seek(0)
-        templates.append(PdfReader(packet))
+        if template_path not in template_pages:
+            data = _load_template(template_path, os.path.getmtime(template_path))
+            template_pages[template_path] = PdfReader(io.BytesIO(data)).pages[0]
+        templates.append(template_pages[template_path])
 
     return templates
 
 
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def _load_template(template_path, mtime):
+    """ Convert the template png into a pdf page. The result is cached
+        per process; the mtime is part of the key such that changed
+        templates are loaded again.
+    """
+    packet = io.BytesIO()
+    can = canvas.Canvas(packet, pagesize=(DEFAULT_IMAGE_WIDTH, DEFAULT_IMAGE_HEIGHT))
+    can.drawImage(template_path, 0, 0)
+    can.save()
+    return packet.getvalue()
+
+
+def _template_page(template, width=DEFAULT_IMAGE_WIDTH, height=DEFAULT_IMAGE_HEIGHT):
+    """ Create a new page which references the (shared) template.
+    """
+    page = PageMerge()
+    page.mbox = [0, 0, width, height]
+    page.add(template)
+    return page.render()
+
+
 def _blank_page(width=DEFAULT_IMAGE_WIDTH, height=DEFAULT_IMAGE_HEIGHT):
     blank = PageMerge()
     blank.mbox = [0, 0, width, height]  # 8.5 x 11
@@ -194,206 +439,75 @@ def _blank_page(width=DEFAULT_IMAGE_WIDTH, height=DEFAULT_IMAGE_HEIGHT):
     return blank
 
 
-def _render_rm_file(rm_file_name, page_layout=None, page_file=None):
+def _render_rm_data(rm_file_name, page_layout=None, page_file=None, style_tolerance=STYLE_TOLERANCE):
     """ Render the .rm files (old .lines). See also
     https://plasma.ninja/blog/devices/remarkable/binary/format/2017/12/26/reMarkable-lines-file-format.html
+    Segments whose width and opacity differ by at most style_tolerance
+    are merged into one path. Returns the content of the overlay pdf.
     """
 
     rm_file = "%s.rm" % rm_file_name
     rm_file_metadata = "%s-metadata.json" % rm_file_name
 
-    # Is this a reMarkable .lines file?
-    with open(rm_file, 'rb') as f:
-        data = f.read()
-    offset = 0
-    expected_header_v3 = b'reMarkable .lines file, version=3          '
-    expected_header_v5 = b'reMarkable .lines file, version=5          '
-    if len(data) < len(expected_header_v5) + 4:
-        print('File too short to be a valid file')
-        os.abort()
-
-    fmt = '<{}sI'.format(len(expected_header_v5))
-    header, nlayers = struct.unpack_from(fmt, data, offset)
-    offset += struct.calcsize(fmt)
-    is_v3 = (header == expected_header_v3)
-    is_v5 = (header == expected_header_v5)
-    if (not is_v3 and not is_v5) or nlayers < 1:
-        print('Not a valid reMarkable file: <header={}><nlayers={}>'.format(header, nlayers))
-        os.abort()
-
-    # Load name of layers; if layer name starts with # we use this color
-    # for this layer
-    layer_colors = [None for _ in range(nlayers)]
-    if os.path.exists(rm_file_metadata):
-        with open(rm_file_metadata, "r") as meta_file:
-            layers = json.loads(meta_file.read())["layers"]
-
-        for l in range(len(layers)):
-            layer = layers[l]
-
-            matches = re.search(r"#([^\s]+)", layer["name"], re.M | re.I)
-            if not matches:
-                continue
-            color_code = matches[0].lower()
-
-            # Try to parse hex code
-            try:
-                has_alpha = len(color_code) > 7
-                layer_colors[l] = colors.HexColor(color_code, hasAlpha=has_alpha)
-                continue
-            except:
-                pass
-
-            # Try to get from name
-            color_code = color_code[1:]
-            color_names = colors.getAllNamedColors()
-            if color_code in color_names:
-                layer_colors[l] = color_names[color_code]
+    page = rm_file_parser.read(rm_file)
+    nlayers = page.num_layers()
 
-            # No valid color found... automatic fallback to default
+    layer_colors = _get_layer_colors(rm_file_metadata, nlayers)
 
     # Iterate through layers on the page (There is at least one)
     packet = io.BytesIO()
     can = canvas.Canvas(packet, pagesize=(page_layout.x_end, page_layout.y_end))
+    style = {}
     for layer in range(nlayers):
-        fmt = '<I'
-        (strokes_count,) = struct.unpack_from(fmt, data, offset)
-        offset += struct.calcsize(fmt)
 
         # Iterate through the strokes in the layer (If there is any)
-        for stroke in range(strokes_count):
-            if is_v3:
-                fmt = '<IIIfI'
-                pen_nr, color, i_unk, width, segments_count = struct.unpack_from(fmt, data, offset)
-                offset += struct.calcsize(fmt)
-            if is_v5:
-                fmt = '<IIIffI'
-                pen_nr, color, i_unk, width, unknown, segments_count = struct.unpack_from(fmt, data, offset)
-                offset += struct.calcsize(fmt)
-
-            last_width = 0
-
-            # Check which tool is used for both, v3 and v5 and set props
-            # https://support.remarkable.com/hc/en-us/articles/115004558545-5-1-Tools-Overview
-            is_highlighter = (pen_nr == 5 or pen_nr == 18)
-            is_eraser = pen_nr == 6
-            is_eraser_area = pen_nr == 8
-            is_sharp_pencil = (pen_nr == 7 or pen_nr == 13)
-            is_tilt_pencil = (pen_nr == 1 or pen_nr == 14)
-            is_marker = (pen_nr == 3 or pen_nr == 16)
-            is_ballpoint = (pen_nr == 2 or pen_nr == 15)
-            is_fineliner = (pen_nr == 4 or pen_nr == 17)
-            is_brush = (pen_nr == 0 or pen_nr == 12)
-            is_calligraphy = pen_nr == 21
-
-            if is_sharp_pencil or is_tilt_pencil:
-                pen = Mechanical_Pencil(page_layout.scale, width, color)
-            if is_brush:
-                pen = Brush(page_layout.scale, width, color)
-            elif is_ballpoint:
-                pen = Ballpoint(page_layout.scale, width, color)
-            elif is_fineliner:
-                pen = Fineliner(page_layout.scale, width, color)
-            elif is_marker:
-                pen = Marker(page_layout.scale, width, color)
-            elif is_calligraphy:
-                pen = Calligraphy(page_layout.scale, width, color)
-            elif is_highlighter:
-                pen = Highlighter(page_layout.scale, 30, color)
-            elif is_eraser:
-                pen = Eraser(page_layout.scale, width, color)
-            elif is_eraser_area:
-                pen = EraseArea(page_layout.scale, width, color)
-            elif is_tilt_pencil:
-                pen = Pencil(page_layout.scale, width, color)
-            elif is_sharp_pencil:
-                pen = Mechanical_Pencil(page_layout.scale, width, color)
-            else:
-                print('Unknown pen: {}'.format(pen_nr))
-                opacity = 0.
-
-            # Iterate through the segments to form a polyline
-            segment_points = []
-            segment_widths = []
-            segment_opacities = []
-            segment_colors = []
-            for segment in range(segments_count):
-                fmt = '<ffffff'
-                x_pos, y_pos, speed, tilt, width, pressure = struct.unpack_from(fmt, data, offset)
-                offset += struct.calcsize(fmt)
-
-                if segment % pen.segment_length == 0:
-                    segment_color = pen.get_segment_color(speed, tilt, width, pressure, last_width)
-                    segment_width = pen.get_segment_width(speed, tilt, width, pressure, last_width)
-                    segment_opacity = pen.get_segment_opacity(speed, tilt, width, pressure, last_width)
-
-                segment_widths.append(segment_width)
-                segment_opacities.append(segment_opacity)
-                if layer_colors[layer] is None:
-                    segment_colors.append(segment_color)
-                else:
-                    segment_colors.append(layer_colors[layer])
-
-                if page_layout.is_landscape:
-                    render_xpos = page_layout.x_end - page_layout.scale * y_pos
-                    render_ypos = page_layout.y_end - page_layout.scale * x_pos
-                else:
-                    render_xpos = page_layout.x_start + page_layout.scale * x_pos
-                    render_ypos = page_layout.y_end - page_layout.scale * y_pos
-                segment_points.extend([render_xpos, render_ypos])
-                last_width = segment_width
-
-            if is_eraser_area or is_eraser:
+        for stroke in page.layers[layer]:
+            pen = _get_pen(stroke.pen_nr, stroke.width, stroke.color, page_layout.scale)
+            if pen is None or isinstance(pen, (Eraser, EraseArea)):
                 continue
 
-            # Render lines after the arrays are filled
-            # such that we have access to the next and previous points
-            can.setLineCap(0 if is_highlighter else 1)
+            # Compute the polyline and the style of all segments at once
+            segments = stroke.segments
+            render_xpos, render_ypos = _get_stroke_points(segments, page_layout)
+            segment_points = np.column_stack((render_xpos, render_ypos)).ravel().tolist()
+
+            speed, tilt, width, pressure = segments["speed"], segments["tilt"], segments["width"], segments["pressure"]
+            segment_widths = pen.get_stroke_widths(speed, tilt, width, pressure).tolist()
+            segment_opacities = pen.get_stroke_opacities(speed, tilt, width, pressure).tolist()
+            if layer_colors[layer] is None:
+                segment_colors = _get_colors(pen.get_stroke_colors(speed, tilt, width, pressure))
+            else:
+                segment_colors = [layer_colors[layer]] * len(segments)
 
-            for i in range(2, len(segment_points), 2):
-                can.setStrokeColor(segment_colors[int(i / 2)])
-                can.setLineWidth(segment_widths[int(i / 2)])
-                can.setStrokeAlpha(segment_opacities[int(i / 2)])
+            # Render lines after the arrays are filled. Consecutive segments
+            # with the same style are drawn as a single polyline and the
+            # graphics state is only changed if the style changes.
+            line_cap = 0 if isinstance(pen, Highlighter) else 1
+            runs = _get_style_runs(segment_widths, segment_opacities, segment_colors, style_tolerance)
+            for start, end in runs:
+                _set_stroke_style(can, style, segment_colors[start], segment_widths[start],
+                                  segment_opacities[start], line_cap)
 
                 p = can.beginPath()
-                p.moveTo(segment_points[i - 2], segment_points[i - 1])
-                p.lineTo(segment_points[i], segment_points[i + 1])
-                p.moveTo(segment_points[i], segment_points[i + 1])
-                p.close()
+                p.moveTo(segment_points[2 * start - 2], segment_points[2 * start - 1])
+                for i in range(2 * start, 2 * end, 2):
+                    p.lineTo(segment_points[i], segment_points[i + 1])
                 can.drawPath(p)
 
     # Special handling to plot snapped highlights
-    if(page_file and os.path.exists(page_file)):
-        with open(page_file, "r") as f:
-            highlights = json.loads(f.read())["highlights"]
-            for h in highlights[0]:
-                rects = h["rects"][0]
-                if page_layout.is_landscape:
-                    render_xpos = page_layout.x_end - page_layout.scale * rects["y"]
-                    render_ypos = page_layout.y_end - page_layout.scale * rects["x"]
-                else:
-                    render_xpos = page_layout.x_start + page_layout.scale * rects["x"]
-                    render_ypos = page_layout.y_end - page_layout.scale * rects["y"]
-
-                width = rects["width"] * page_layout.scale
-                height = rects["height"] * page_layout.scale
-                render_ypos -= height / 2
-
-                can.setStrokeColor(default_stroke_color[3])
-                can.setLineWidth(height)
-                can.setStrokeAlpha(0.2)
+    for render_xpos, render_ypos, width, height in _get_highlights(page_file, page_layout):
+        can.setStrokeColor(default_stroke_color[3])
+        can.setLineWidth(height)
+        can.setStrokeAlpha(0.2)
 
-                p = can.beginPath()
-                p.moveTo(render_xpos, render_ypos)
-                p.lineTo(render_xpos+width, render_ypos)
-                p.close()
-                can.drawPath(p)
+        p = can.beginPath()
+        p.moveTo(render_xpos, render_ypos)
+        p.lineTo(render_xpos+width, render_ypos)
+        p.close()
+        can.drawPath(p)
 
     can.save()
-    packet.seek(0)
-    overlay = PdfReader(packet)
-
-    return overlay
+    return packet.getvalue()
 
 
 def _get_color(color):
@@ -403,6 +517,183 @@ def _get_color(color):
         return colors.Color(color[0], color[1], color[2], color[3])
 
 
+def _get_layer_colors(rm_file_metadata, nlayers):
+    """ Load name of layers; if layer name starts with # we use this color
+        for this layer. Returns None for layers without a color.
+    """
+    layer_colors = [None for _ in range(nlayers)]
+    if not os.path.exists(rm_file_metadata):
+        return layer_colors
+
+    with open(rm_file_metadata, "r") as meta_file:
+        layers = json.loads(meta_file.read())["layers"]
+
+    for l in range(min(len(layers), nlayers)):
+        layer = layers[l]
+
+        matches = re.search(r"#([^\s]+)", layer["name"], re.M | re.I)
+        if not matches:
+            continue
+        color_code = matches[0].lower()
+
+        # Try to parse hex code
+        try:
+            has_alpha = len(color_code) > 7
+            layer_colors[l] = colors.HexColor(color_code, hasAlpha=has_alpha)
+            continue
+        except:
+            pass
+
+        # Try to get from name
+        color_code = color_code[1:]
+        color_names = colors.getAllNamedColors()
+        if color_code in color_names:
+            layer_colors[l] = color_names[color_code]
+
+        # No valid color found... automatic fallback to default
+
+    return layer_colors
+
+
+def _get_pen(pen_nr, width, color, scale):
+    """ Check which tool is used for both, v3 and v5 and set props
+        https://support.remarkable.com/hc/en-us/articles/115004558545-5-1-Tools-Overview
+    """
+    if pen_nr == 0 or pen_nr == 12:
+        return Brush(scale, width, color)
+    elif pen_nr == 2 or pen_nr == 15:
+        return Ballpoint(scale, width, color)
+    elif pen_nr == 4 or pen_nr == 17:
+        return Fineliner(scale, width, color)
+    elif pen_nr == 3 or pen_nr == 16:
+        return Marker(scale, width, color)
+    elif pen_nr == 21:
+        return Calligraphy(scale, width, color)
+    elif pen_nr == 5 or pen_nr == 18:
+        return Highlighter(scale, 30, color)
+    elif pen_nr == 6:
+        return Eraser(scale, width, color)
+    elif pen_nr == 8:
+        return EraseArea(scale, width, color)
+    elif pen_nr == 1 or pen_nr == 14:
+        return Pencil(scale, width, color)
+    elif pen_nr == 7 or pen_nr == 13:
+        return Mechanical_Pencil(scale, width, color)
+
+    print('Unknown pen: {}'.format(pen_nr))
+    return None
+
+
+def _get_stroke_points(segments, page_layout):
+    """ Returns the x and y coordinates of all points of a stroke in the
+        coordinate system of the pdf page.
+    """
+    x = segments["x"].astype(np.float64)
+    y = segments["y"].astype(np.float64)
+    if page_layout.is_landscape:
+        return page_layout.x_end - page_layout.scale * y, page_layout.y_end - page_layout.scale * x
+    return page_layout.x_start + page_layout.scale * x, page_layout.y_end - page_layout.scale * y
+
+
+def _get_highlights(page_file, page_layout):
+    """ Returns the snapped highlights of a page as list of lines
+        (x, y, width, height) in the coordinate system of the pdf page,
+        where y is the center of the line.
+    """
+    if not page_file or not os.path.exists(page_file):
+        return []
+
+    with open(page_file, "r") as f:
+        highlights = json.loads(f.read())["highlights"]
+
+    lines = []
+    for h in highlights[0]:
+        rects = h["rects"][0]
+        if page_layout.is_landscape:
+            render_xpos = page_layout.x_end - page_layout.scale * rects["y"]
+            render_ypos = page_layout.y_end - page_layout.scale * rects["x"]
+        else:
+            render_xpos = page_layout.x_start + page_layout.scale * rects["x"]
+            render_ypos = page_layout.y_end - page_layout.scale * rects["y"]
+
+        width = rects["width"] * page_layout.scale
+        height = rects["height"] * page_layout.scale
+        render_ypos -= height / 2
+        lines.append((render_xpos, render_ypos, width, height))
+
+    return lines
+
+
+def _get_style_runs(widths, opacities, colors, tolerance):
+    """ Split the segments of a stroke into runs of equal style. Segment i
+        connects point i-1 with point i and is drawn with the style of
+        point i. Returns a list of (start, end) tuples, end is exclusive.
+    """
+    runs = []
+    start = 1
+    for i in range(2, len(widths)):
+        is_same_style = colors[i] is colors[start] and \
+            abs(widths[i] - widths[start]) <= tolerance and \
+            abs(opacities[i] - opacities[start]) <= tolerance
+        if not is_same_style:
+            runs.append((start, i))
+            start = i
+
+    if start < len(widths):
+        runs.append((start, len(widths)))
+    return runs
+
+
+def _set_stroke_style(can, style, color, width, opacity, line_cap):
+    """ Set the stroke style of the canvas. The style dict contains the
+        current state, only values that changed are written.
+    """
+    if style.get("color") != color:
+        # setStrokeColor also sets the alpha (of the color), therefore
+        # the opacity must be written again
+        can.setStrokeColor(color)
+        style["color"] = color
+        style.pop("opacity", None)
+    if style.get("width") != width:
+        can.setLineWidth(width)
+        style["width"] = width
+    if style.get("opacity") != opacity:
+        can.setStrokeAlpha(opacity)
+        style["opacity"] = opacity
+    if style.get("line_cap") != line_cap:
+        can.setLineCap(line_cap)
+        can.setLineJoin(line_cap)
+        style["line_cap"] = line_cap
+
+
+def _get_colors(segment_colors):
+    """ Convert an array of rgb(a) values into reportlab colors. Equal
+        values share the same color object.
+    """
+    cache = {}
+    result = []
+    for color in map(tuple, segment_colors.tolist()):
+        if color not in cache:
+            cache[color] = _get_color(color)
+        result.append(cache[color])
+    return result
+
+
+def _linear_recurrence(a, b):
+    """ Solve w[k] = a[k] + b * w[k-1] with w[-1] = 0 for all k at once.
+        The sums are built by doubling the look back in every step,
+        such that only log2(len(a)) array operations are needed.
+    """
+    w = np.array(a, dtype=np.float64)
+    coefficient = b
+    shift = 1
+    while shift < len(w) and coefficient != 0:
+        w[shift:] = w[shift:] + coefficient * w[:-shift]
+        coefficient = coefficient * coefficient
+        shift *= 2
+    return w
+
+
 #
 # Credit: https://github.com/lschwetlick/maxio
 #
@@ -428,6 +719,39 @@ class Pen:
         """return value in [0, 1]"""
         return max(0, min(1, value))
 
+    #
+    # Batch form: Same as get_segment_* but for all points of a stroke.
+    # Values are only evaluated for every segment_length-th point and
+    # hold until the next one. The _get_* functions are implemented by
+    # each pen and work on those sampled points only.
+    #
+    def get_stroke_widths(self, speed, tilt, width, pressure):
+        sampled = self._sample(speed, tilt, width, pressure)
+        return self._expand(self._get_widths(*sampled), len(speed))
+
+    def get_stroke_colors(self, speed, tilt, width, pressure):
+        sampled = self._sample(speed, tilt, width, pressure)
+        return self._expand(self._get_colors(*sampled), len(speed))
+
+    def get_stroke_opacities(self, speed, tilt, width, pressure):
+        sampled = self._sample(speed, tilt, width, pressure)
+        return self._expand(self._get_opacities(*sampled), len(speed))
+
+    def _get_widths(self, speed, tilt, width, pressure):
+        return np.full(len(speed), self.base_width * self.ratio, dtype=np.float64)
+
+    def _get_colors(self, speed, tilt, width, pressure):
+        return np.tile(np.asarray(self.base_color, dtype=np.float64), (len(speed), 1))
+
+    def _get_opacities(self, speed, tilt, width, pressure):
+        return np.full(len(speed), self.base_opacity, dtype=np.float64)
+
+    def _sample(self, *values):
+        return [np.asarray(v, dtype=np.float64)[::self.segment_length] for v in values]
+
+    def _expand(self, sampled, length):
+        return np.repeat(sampled, self.segment_length, axis=0)[:length]
+
 
 class Fineliner(Pen):
     def __init__(self, ratio, base_width, base_color):
@@ -446,6 +770,10 @@ class Ballpoint(Pen):
         segment_width = (0.5 + pressure) + (1 * width) - 0.5 * (speed / 50)
         return segment_width * self.ratio
 
+    def _get_widths(self, speed, tilt, width, pressure):
+        segment_width = (0.5 + pressure) + (1 * width) - 0.5 * (speed / 50)
+        return segment_width * self.ratio
+
     # def get_segment_color(self, speed, tilt, width, pressure, last_width):
     #     intensity = (0.1 * -(speed / 35)) + (1.2 * pressure) + 0.5
     #     intensity = self.cutoff(intensity)
@@ -465,6 +793,10 @@ class Marker(Pen):
         segment_width = 0.9 * (((1 * width)) - 0.4 * tilt) + (0.1 * last_width)
         return segment_width * self.ratio
 
+    def _get_widths(self, speed, tilt, width, pressure):
+        segment_width = 0.9 * (((1 * width)) - 0.4 * tilt)
+        return _linear_recurrence(segment_width * self.ratio, 0.1 * self.ratio)
+
 
 class Pencil(Pen):
     def __init__(self, ratio, base_width, base_color):
@@ -484,6 +816,17 @@ class Pencil(Pen):
         segment_opacity = max(0.05, min(0.7, pressure ** 3))
         return self.cutoff(segment_opacity)
 
+    def _get_widths(self, speed, tilt, width, pressure):
+        segment_width = 0.5 * ((((0.8 * self.base_width) + (0.5 * pressure)) * (1 * width)) - (
+                0.25 * tilt ** 1.8))
+        max_width = self.base_width * 10
+        segment_width = np.where(segment_width < max_width, segment_width, max_width)
+        return segment_width * self.ratio
+
+    def _get_opacities(self, speed, tilt, width, pressure):
+        segment_opacity = np.maximum(0.05, np.minimum(0.7, pressure ** 3))
+        return np.clip(segment_opacity, 0, 1)
+
 
 class Mechanical_Pencil(Pen):
     def __init__(self, ratio, base_width, base_color):
@@ -506,6 +849,11 @@ class Brush(Pen):
                 ((1 + (1.4 * pressure)) * (1 * width)) - (0.5 * tilt) - (0.5 * speed / 50))  # + (0.2 * last_width)
         return segment_width * self.ratio
 
+    def _get_widths(self, speed, tilt, width, pressure):
+        segment_width = 0.7 * (
+                ((1 + (1.4 * pressure)) * (1 * width)) - (0.5 * tilt) - (0.5 * speed / 50))
+        return segment_width * self.ratio
+
     # def get_segment_color(self, speed, tilt, width, pressure, last_width):
     #     intensity = (pressure ** 1.5  - 0.2 * (speed / 50))*1.5
     #     intensity = self.cutoff(intensity)
@@ -556,3 +904,7 @@ class Calligraphy(Pen):
     def get_segment_width(self, speed, tilt, width, pressure, last_width):
         segment_width = 0.5 * (((1 + pressure) * (1 * width)) - 0.3 * tilt) + (0.2 * last_width)
         return segment_width * self.ratio
+
+    def _get_widths(self, speed, tilt, width, pressure):
+        segment_width = 0.5 * (((1 + pressure) * (1 * width)) - 0.3 * tilt)
+        return _linear_recurrence(segment_width * self.ratio, 0.2 * self.ratio)
@@ -0,0 +1,119 @@
+import struct
+
+import numpy as np
+
+
+#
+# DEFINITIONS
+#
+HEADER_V3 = b'reMarkable .lines file, version=3          '
+HEADER_V5 = b'reMarkable .lines file, version=5          '
+
+# Every point of a stroke is stored as six little endian floats. We read
+# all points of a stroke at once as a structured array.
+SEGMENT_DTYPE = np.dtype([
+    ("x", "<f4"),
+    ("y", "<f4"),
+    ("speed", "<f4"),
+    ("tilt", "<f4"),
+    ("width", "<f4"),
+    ("pressure", "<f4")
+])
+
+_FMT_HEADER = '<{}sI'.format(len(HEADER_V5))
+_FMT_COUNT = '<I'
+_FMT_STROKE_V3 = '<IIIfI'
+_FMT_STROKE_V5 = '<IIIffI'
+
+
+#
+# CLASSES
+#
+class Stroke(object):
+    """ A single stroke of a layer. All points are stored in segments,
+        a structured numpy array (see SEGMENT_DTYPE) that directly
+        references the data of the .rm file (zero copy).
+    """
+
+    def __init__(self, pen_nr, color, width, segments):
+        self.pen_nr = pen_nr
+        self.color = color
+        self.width = width
+        self.segments = segments
+
+    def __len__(self):
+        return len(self.segments)
+
+
+class Page(object):
+    """ Parsed .rm file. layers is a list of layers where each layer
+        is a list of strokes.
+    """
+
+    def __init__(self, version, layers):
+        self.version = version
+        self.layers = layers
+
+    def num_layers(self):
+        return len(self.layers)
+
+    def num_strokes(self):
+        return sum(len(strokes) for strokes in self.layers)
+
+    def num_segments(self):
+        return sum(len(stroke) for strokes in self.layers for stroke in strokes)
+
+
+#
+# API
+#
+def read(rm_file):
+    """ Read and parse the given .rm file (old .lines). See also
+    https://plasma.ninja/blog/devices/remarkable/binary/format/2017/12/26/reMarkable-lines-file-format.html
+    """
+    with open(rm_file, 'rb') as f:
+        data = f.read()
+    return parse(data)
+
+
+def parse(data):
+    """ Parse the content of a .rm file (v3 or v5). Only the layer and
+        stroke headers are unpacked one by one, the points of each stroke
+        are read as a single structured array.
+    """
+    if len(data) < len(HEADER_V5) + 4:
+        raise Exception("File too short to be a valid file")
+
+    offset = 0
+    header, nlayers = struct.unpack_from(_FMT_HEADER, data, offset)
+    offset += struct.calcsize(_FMT_HEADER)
+    is_v3 = (header == HEADER_V3)
+    is_v5 = (header == HEADER_V5)
+    if (not is_v3 and not is_v5) or nlayers < 1:
+        raise Exception("Not a valid reMarkable file: <header={}><nlayers={}>".format(header, nlayers))
+
+    fmt_stroke = _FMT_STROKE_V3 if is_v3 else _FMT_STROKE_V5
+    size_count = struct.calcsize(_FMT_COUNT)
+    size_stroke = struct.calcsize(fmt_stroke)
+
+    layers = []
+    for _ in range(nlayers):
+        (strokes_count,) = struct.unpack_from(_FMT_COUNT, data, offset)
+        offset += size_count
+
+        strokes = []
+        for _ in range(strokes_count):
+            stroke_header = struct.unpack_from(fmt_stroke, data, offset)
+            offset += size_stroke
+
+            # v5 contains an additional (unknown) float after the width
+            pen_nr, color, _, width = stroke_header[:4]
+            segments_count = stroke_header[-1]
+
+            segments = np.frombuffer(data, dtype=SEGMENT_DTYPE, count=segments_count, offset=offset)
+            offset += segments_count * SEGMENT_DTYPE.itemsize
+
+            strokes.append(Stroke(pen_nr, color, width, segments))
+        layers.append(strokes)
+
+    return Page(3 if is_v3 else 5, layers)
@@ -0,0 +1,313 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import api.remarkable_client
+import model.item
+import utils.config as cfg
+from utils.helper import Singleton
+
+
+#
+# EVENTS
+#
+SYNC_ITEM_SUCCESS = 0
+SYNC_ITEM_FAILED = 1
+SYNC_DONE = 2
+SYNC_ITEM_SKIPPED = 3       # Cancelled or synced outside of the engine
+
+# Priorities (lower values are synced first)
+PRIORITY_OPEN = 0           # User opens a document
+PRIORITY_USER = 1           # User explicitly syncs items
+PRIORITY_BACKGROUND = 2     # Full sync after the start
+PRIORITY_PREFETCH = 3       # Documents that may be needed soon
+
+
+#
+# DEFINITIONS
+#
+# Number of documents that are rendered at the same time (config:
+# sync.render_workers). The render stage runs in threads, because
+# documents (state, listeners) can not be moved into other processes.
+# The cpu bound part is moved out of these threads by model.render:
+# pages of documents with at least render.PARALLEL_MIN_PAGES annotated
+# pages are rendered in its process pool. Smaller documents are rendered
+# in the render thread; the download threads mostly wait for the network
+# (without holding the GIL), so they are not slowed down much.
+RENDER_CONCURRENCY = 2
+
+# Max. number of downloaded documents that wait for rendering per
+# download worker. If rendering is slower than downloading, downloads
+# are paused until the queue has space again.
+QUEUE_SIZE_PER_WORKER = 2
+
+
+class SyncJob(object):
+    """ A sync request for some items (and all their children). The job
+        can be cancelled; items that are already downloading are finished
+        but all other items are skipped. listener(code, job, item) is
+        called for every synced item and once at the end (item=None).
+    """
+
+    def __init__(self, items, force=False, listener=None, priority=PRIORITY_USER):
+        self.items = items
+        self.force = force
+        self.listener = listener
+        self.priority = priority
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+        self.skipped = 0
+        self.errors = {}
+        self.cancelled = False
+        self._finished = threading.Event()
+        self._pending = 0
+
+
+    def cancel(self):
+        self.cancelled = True
+
+
+    def is_done(self):
+        return self._finished.is_set()
+
+
+    def wait(self, timeout=None):
+        return self._finished.wait(timeout)
+
+
+    def progress(self):
+        """ Returns (processed_items, total_items), processed items are
+            synced, failed or skipped ones. total_items is known once the
+            tree is traversed.
+        """
+        return self.done + self.failed + self.skipped, self.total
+
+
+    def _publish(self, code, item=None):
+        if self.listener is None:
+            return
+
+        try:
+            self.listener(code, self, item)
+        except Exception as e:
+            print("(Warning) Failed to publish sync event.")
+            print(e)
+
+
+class _Task(object):
+    """ A document that is queued or synced. All jobs that requested the
+        document are informed once it is synced.
+    """
+
+    def __init__(self, document, priority, seq):
+        self.document = document
+        self.priority = priority
+        self.seq = seq
+        self.jobs = []
+        self.is_running = False
+
+
+    def is_cancelled(self):
+        return all(job.cancelled for job in self.jobs)
+
+
+class SyncEngine(metaclass=Singleton):
+    """ Syncs items independent of the gui. Documents pass through two
+        stages: Downloads run in network.workers threads that are driven
+        by an asyncio loop and rendering runs in sync.render_workers
+        threads (see RENDER_CONCURRENCY for why these are no processes).
+        Both stages are connected by a bounded queue which pauses the
+        downloads if rendering can not keep up. All jobs share
+        the same workers; documents with a higher priority (e.g. opened
+        by the user) are synced first.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loop = None
+        self.thread = None
+        self.tasks = {}
+        self.seq = 0
+
+
+    def sync(self, items, force=False, listener=None, priority=PRIORITY_USER):
+        """ Sync the given items and all children that are not synced yet
+            (or all if force is set). Documents that are already queued
+            are moved up if the new priority is higher. Returns the
+            SyncJob immediately.
+        """
+        job = SyncJob(items, force, listener, priority)
+        loop = self._get_loop()
+        asyncio.run_coroutine_threadsafe(self._enqueue(job), loop)
+        return job
+
+
+    def _get_loop(self):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+                asyncio.run_coroutine_threadsafe(self._start(), self.loop).result()
+            return self.loop
+
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+
+    async def _start(self):
+        network_workers = api.remarkable_client.get_worker_count()
+        render_workers = max(1, int(cfg.get("sync.render_workers", RENDER_CONCURRENCY)))
+
+        self.network_executor = ThreadPoolExecutor(network_workers, thread_name_prefix="sync-network")
+        self.render_executor = ThreadPoolExecutor(render_workers, thread_name_prefix="sync-render")
+        self.download_queue = asyncio.PriorityQueue()
+        self.render_queue = asyncio.PriorityQueue(maxsize=network_workers * QUEUE_SIZE_PER_WORKER)
+
+        self.workers = []
+        for _ in range(network_workers):
+            self.workers.append(asyncio.ensure_future(self._download_worker()))
+        for _ in range(render_workers):
+            self.workers.append(asyncio.ensure_future(self._render_worker()))
+
+
+    async def _enqueue(self, job):
+        # The traversal writes the metadata of collections; this must not
+        # block the loop (and therefore all download workers)
+        loop = asyncio.get_event_loop()
+        try:
+            documents = await loop.run_in_executor(None, _collect, job)
+        except Exception as e:
+            # Errors that belong to no document are stored with id None
+            print("(Error) Failed to collect the items to sync.")
+            print(e)
+            job.errors[None] = e
+            self._finish(job)
+            return
+
+        job.total = len(documents)
+        job._pending = len(documents)
+        for document in documents:
+            self._schedule(job, document)
+
+        if job._pending <= 0:
+            self._finish(job)
+
+
+    def _schedule(self, job, document):
+        task = self.tasks.get(document.id())
+        if task is None:
+            task = _Task(document, job.priority, self._next_seq())
+            self.tasks[document.id()] = task
+            task.jobs.append(job)
+            self.download_queue.put_nowait((task.priority, task.seq, task))
+            return
+
+        task.jobs.append(job)
+        if not task.is_running and job.priority < task.priority:
+            # The old queue entry is skipped as its seq is outdated
+            task.priority = job.priority
+            task.seq = self._next_seq()
+            self.download_queue.put_nowait((task.priority, task.seq, task))
+
+
+    def _next_seq(self):
+        self.seq += 1
+        return self.seq
+
+
+    async def _download_worker(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            _, seq, task = await self.download_queue.get()
+            try:
+                if seq != task.seq or task.is_running:
+                    continue
+
+                if task.is_cancelled():
+                    self._task_done(task, skipped=True)
+                    continue
+
+                task.is_running = True
+                changed_files = await loop.run_in_executor(self.network_executor, task.document.download)
+                if changed_files is None:
+                    # Already synced outside of the engine
+                    self._task_done(task, skipped=True)
+                    continue
+
+                # Waits if the renderer is busy (back-pressure)
+                await self.render_queue.put((task.priority, task.seq, task, changed_files))
+            except Exception as e:
+                self._task_done(task, e)
+            finally:
+                self.download_queue.task_done()
+
+
+    async def _render_worker(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            _, _, task, changed_files = await self.render_queue.get()
+            try:
+                await loop.run_in_executor(self.render_executor, task.document.render_annotations, changed_files)
+                self._task_done(task, success=True)
+            except Exception as e:
+                self._task_done(task, e)
+            finally:
+                self.render_queue.task_done()
+
+
+    def _task_done(self, task, error=None, success=False, skipped=False):
+        del self.tasks[task.document.id()]
+        for job in task.jobs:
+            if error is not None:
+                job.failed += 1
+                job.errors[task.document.id()] = error
+                job._publish(SYNC_ITEM_FAILED, task.document)
+            elif success:
+                job.done += 1
+                job._publish(SYNC_ITEM_SUCCESS, task.document)
+            elif skipped:
+                job.skipped += 1
+                job._publish(SYNC_ITEM_SKIPPED, task.document)
+
+            job._pending -= 1
+            if job._pending <= 0:
+                self._finish(job)
+
+
+    def _finish(self, job):
+        job._publish(SYNC_DONE)
+        job._finished.set()
+
+
+def _collect(job):
+    """ Returns all documents of the job that must be synced. Collections
+        are synced directly as they only store their metadata locally.
+    """
+    documents = {}
+
+    def collect(item):
+        if item.is_root():
+            return
+        if not job.force and item.state == model.item.STATE_SYNCED:
+            return
+
+        if item.is_document():
+            documents[item.id()] = item
+        else:
+            item.sync()
+
+    for item in job.items:
+        _traverse(item, collect)
+    return list(documents.values())
+
+
+def _traverse(item, fun):
+    """ Call fun for all items of the subtree (children first)
+    """
+    for child in item.children():
+        _traverse(child, fun)
+    fun(item)
@@ -0,0 +1,360 @@
+""" Local stand-in for the rm cloud to test and benchmark RemaPy offline.
+    It emulates the token endpoints, docs, upload/request,
+    upload/update-status, delete and blob GET/PUT (with range support).
+    Latency, bandwidth and error rates can be configured. Point the
+    client to it with
+
+        cfg.save({"network": {"base_url": server.url, "auth_url": server.url}})
+
+    or start it standalone:
+
+        PYTHONPATH=. python test/cloud_server.py --fixtures testcases/annotation --items 50000
+"""
+import argparse
+import io
+import json
+import os
+import random
+import threading
+import time
+import uuid
+import zipfile
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import rm_generator
+
+
+#
+# DEFINITIONS
+#
+DOCS_PATH = "/document-storage/json/2/docs"
+UPLOAD_REQUEST_PATH = "/document-storage/json/2/upload/request"
+UPDATE_STATUS_PATH = "/document-storage/json/2/upload/update-status"
+DELETE_PATH = "/document-storage/json/2/delete"
+DEVICE_TOKEN_PATH = "/token/json/2/device/new"
+USER_TOKEN_PATH = "/token/json/2/user/new"
+BLOB_PATH = "/blob/"
+
+BLOB_URL_LIFETIME = timedelta(hours=1)
+
+# Marker for blobs of synthetic documents
+SYNTHETIC = object()
+
+
+class CloudServer(object):
+    """ Serves the documents of a fixture directory (every subdirectory
+        <id>/ with <id>.content etc. as in testcases/ is a document) and
+        a number of synthetic items. latency (seconds) is added to every
+        request, bandwidth (bytes/s) limits blob transfers and error_rate
+        is the probability that a request fails with 500.
+    """
+
+    def __init__(self, fixtures=None, items=0, latency=0.0, bandwidth=None, error_rate=0.0, port=0, seed=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.items = {}
+        self.blobs = {}
+        self.requests = {}
+        self.synthetic_page = None
+        self.is_running = False
+
+        if fixtures is not None:
+            self._load_fixtures(fixtures)
+        if items > 0:
+            self._create_items(items)
+
+        server = self
+        class Handler(_Handler):
+            cloud = server
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.httpd.daemon_threads = True
+        self.url = "http://127.0.0.1:%d" % self.httpd.server_address[1]
+        self.thread = None
+
+
+    def start(self):
+        self.is_running = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+
+    def stop(self):
+        # Open keep-alive connections are closed with their next request
+        self.is_running = False
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+    def count(self, endpoint):
+        """ Number of requests that were sent to the given endpoint
+            (e.g. DOCS_PATH or BLOB_PATH).
+        """
+        with self.lock:
+            return self.requests.get(endpoint, 0)
+
+
+    def add_item(self, metadata, blob=None):
+        with self.lock:
+            self.items[metadata["ID"]] = metadata
+            if blob is not None:
+                self.blobs[metadata["ID"]] = blob
+
+
+    def _load_fixtures(self, path):
+        for id in sorted(os.listdir(path)):
+            if not os.path.isdir(os.path.join(path, id)):
+                continue
+
+            blob = io.BytesIO()
+            with zipfile.ZipFile(blob, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+                for root, _, files in os.walk(os.path.join(path, id)):
+                    for file in files:
+                        file_path = os.path.join(root, file)
+                        zf.write(file_path, os.path.relpath(file_path, os.path.join(path, id)))
+            self.add_item(_metadata(id, id, "DocumentType"), blob.getvalue())
+
+
+    def _create_items(self, count):
+        """ Create count items in a few collections. All documents are
+            small notebooks with the same page; their zips are created
+            when they are downloaded.
+        """
+        self.synthetic_page = rm_generator.generate(strokes=20, points=50)
+
+        collections = [str(uuid.UUID(int=self.random.getrandbits(128))) for _ in range(max(1, count // 100))]
+        for i, id in enumerate(collections):
+            self.add_item(_metadata(id, "Collection %d" % i, "CollectionType"))
+
+        for i in range(count - len(collections)):
+            id = str(uuid.UUID(int=self.random.getrandbits(128)))
+            parent = collections[i % len(collections)]
+            self.add_item(_metadata(id, "Document %d" % i, "DocumentType", parent), SYNTHETIC)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    cloud = None
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def _handle(self, method):
+        cloud = self.cloud
+        url = urlparse(self.path)
+        body = self._read_body()
+
+        if not cloud.is_running:
+            self.close_connection = True
+            return
+
+        endpoint = BLOB_PATH if url.path.startswith(BLOB_PATH) else url.path
+        with cloud.lock:
+            cloud.requests[endpoint] = cloud.requests.get(endpoint, 0) + 1
+
+        if cloud.latency > 0:
+            time.sleep(cloud.latency)
+
+        if cloud.error_rate > 0 and cloud.random.random() < cloud.error_rate:
+            self._send(500, b"Internal error")
+            return
+
+        if method == "POST" and url.path in (DEVICE_TOKEN_PATH, USER_TOKEN_PATH):
+            self._send(200, ("token-%s" % uuid.uuid4()).encode("utf-8"))
+
+        elif method == "GET" and url.path == DOCS_PATH:
+            self._list(parse_qs(url.query))
+
+        elif method == "PUT" and url.path == UPLOAD_REQUEST_PATH:
+            self._upload_request(json.loads(body))
+
+        elif method == "PUT" and url.path == UPDATE_STATUS_PATH:
+            self._update_status(json.loads(body))
+
+        elif method == "PUT" and url.path == DELETE_PATH:
+            self._delete(json.loads(body))
+
+        elif url.path.startswith(BLOB_PATH):
+            id = url.path[len(BLOB_PATH):]
+            if method == "GET":
+                self._get_blob(id)
+            else:
+                with cloud.lock:
+                    cloud.blobs[id] = body
+                self._send(200, b"")
+
+        else:
+            self._send(404, b"Not found")
+
+
+    def _list(self, query):
+        with_blob = query.get("withBlob", ["false"])[0].lower() == "true"
+        with self.cloud.lock:
+            if "doc" in query:
+                items = [self.cloud.items[id] for id in query["doc"] if id in self.cloud.items]
+            else:
+                items = list(self.cloud.items.values())
+
+            result = []
+            expires = (datetime.utcnow() + BLOB_URL_LIFETIME).strftime("%Y-%m-%dT%H:%M:%S.000000000Z")
+            for item in items:
+                item = dict(item)
+                if with_blob and item["Type"] == "DocumentType":
+                    item["BlobURLGet"] = "%s%s%s" % (self.cloud.url, BLOB_PATH, item["ID"])
+                    item["BlobURLGetExpires"] = expires
+                result.append(item)
+        self._send_json(result)
+
+
+    def _upload_request(self, entries):
+        result = []
+        for entry in entries:
+            result.append({
+                "ID": entry["ID"],
+                "Version": entry.get("Version", 1),
+                "Message": "",
+                "Success": True,
+                "BlobURLPut": "%s%s%s" % (self.cloud.url, BLOB_PATH, entry["ID"]),
+                "BlobURLPutExpires": (datetime.utcnow() + BLOB_URL_LIFETIME).strftime("%Y-%m-%dT%H:%M:%SZ")
+            })
+        self._send_json(result)
+
+
+    def _update_status(self, entries):
+        result = []
+        with self.cloud.lock:
+            for entry in entries:
+                metadata = dict(self.cloud.items.get(entry["ID"], {}))
+                metadata.update(entry)
+                self.cloud.items[entry["ID"]] = metadata
+                result.append({"ID": entry["ID"], "Version": metadata["Version"], "Message": "", "Success": True})
+        self._send_json(result)
+
+
+    def _delete(self, entries):
+        result = []
+        with self.cloud.lock:
+            for entry in entries:
+                item = self.cloud.items.get(entry["ID"])
+                if item is None or item["Version"] != entry["Version"]:
+                    result.append({"ID": entry["ID"], "Message": "Item not found or outdated", "Success": False})
+                    continue
+
+                del self.cloud.items[entry["ID"]]
+                self.cloud.blobs.pop(entry["ID"], None)
+                result.append({"ID": entry["ID"], "Message": "", "Success": True})
+        self._send_json(result)
+
+
+    def _get_blob(self, id):
+        with self.cloud.lock:
+            blob = self.cloud.blobs.get(id)
+        if blob is SYNTHETIC:
+            blob = _notebook_blob(id, self.cloud.synthetic_page)
+        if blob is None:
+            self._send(404, b"Not found")
+            return
+
+        offset = 0
+        range_header = self.headers.get("Range")
+        if range_header and range_header.startswith("bytes="):
+            offset = int(range_header[len("bytes="):].split("-")[0])
+
+        etag = '"%s-%d"' % (id, len(blob))
+        if offset > 0 and self.headers.get("If-Range", etag) == etag:
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (offset, len(blob) - 1, len(blob)))
+        else:
+            offset = 0
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(blob) - offset))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self._write_throttled(blob[offset:])
+
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length > 0 else b""
+
+
+    def _send_json(self, data):
+        self._send(200, json.dumps(data).encode("utf-8"), "application/json")
+
+
+    def _send(self, status, data, content_type="text/plain"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+    def _write_throttled(self, data):
+        bandwidth = self.cloud.bandwidth
+        if bandwidth is None or bandwidth <= 0:
+            self.wfile.write(data)
+            return
+
+        chunk_size = max(1024, int(bandwidth / 10))
+        for start in range(0, len(data), chunk_size):
+            self.wfile.write(data[start:start+chunk_size])
+            time.sleep(len(data[start:start+chunk_size]) / bandwidth)
+
+
+def _metadata(id, name, type, parent=""):
+    return {
+        "ID": id,
+        "Parent": parent,
+        "VissibleName": name,
+        "Type": type,
+        "Version": 1,
+        "ModifiedClient": "2020-01-01T00:00:00.000000Z",
+        "CurrentPage": 0,
+        "Bookmarked": False,
+    }
+
+
+def _notebook_blob(id, page):
+    blob = io.BytesIO()
+    with zipfile.ZipFile(blob, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("%s.content" % id, json.dumps({"fileType": "notebook", "orientation": "portrait", "pages": ["p0"]}))
+        zf.writestr("%s.pagedata" % id, "Blank")
+        zf.writestr("%s/0.rm" % id, page)
+    return blob.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the rm cloud.")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--fixtures", default=None, help="Directory with documents as in testcases/")
+    parser.add_argument("--items", type=int, default=0, help="Number of synthetic items")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every request")
+    parser.add_argument("--bandwidth", type=float, default=None, help="Max. bytes/s per blob download")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probability of 500 responses")
+    args = parser.parse_args()
+
+    server = CloudServer(args.fixtures, args.items, args.latency, args.bandwidth, args.error_rate, args.port)
+    server.is_running = True
+    print("Serving %d items on %s" % (len(server.items), server.url))
+    server.httpd.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+# Use a temporary config and data directory such that the user data is
+# not touched
+TMP_PATH = tempfile.mkdtemp()
+os.environ["XDG_CONFIG_HOME"] = os.path.join(TMP_PATH, "config")
+os.environ["XDG_DATA_HOME"] = os.path.join(TMP_PATH, "data")
+
+import utils.config as cfg
+import model.item
+from model.item_manager import ItemManager
+from model.sync_engine import SyncEngine, PRIORITY_BACKGROUND
+from cloud_server import CloudServer, DOCS_PATH, BLOB_PATH
+
+INPUT_BASE_PATH = "./testcases/annotation/"
+SYNTHETIC_ITEMS = 200
+
+
+server = CloudServer(fixtures=INPUT_BASE_PATH, items=SYNTHETIC_ITEMS).start()
+os.makedirs(cfg.PATH, exist_ok=True)
+cfg.save({
+    "network": {"base_url": server.url, "auth_url": server.url},
+    "authentication": {"user_token": "test"}
+})
+
+print("Load tree...")
+item_manager = ItemManager()
+root, is_online = item_manager.get_root()
+documents = []
+item_manager.traverse_tree(fun=documents.append, document=True, collection=False)
+assert is_online
+assert len(documents) == len(server.items) - SYNTHETIC_ITEMS // 100
+
+print("Sync %d documents..." % len(documents))
+start = time.perf_counter()
+job = SyncEngine().sync([root], priority=PRIORITY_BACKGROUND)
+job.wait()
+print("Synced in %.1fs" % (time.perf_counter() - start))
+assert job.failed == 0, job.errors
+assert server.count(DOCS_PATH) == 1
+assert server.count(BLOB_PATH) == len(documents)
+assert all(os.path.exists(document.ann_or_orig_file()) for document in documents)
+
+print("Bookmark and delete...")
+failed = item_manager.set_bookmarked(documents, True)
+assert len(failed) == 0
+assert all(server.items[document.id()]["Bookmarked"] for document in documents)
+
+deleted, failed = item_manager.delete_items(documents[:50])
+assert len(deleted) == 50 and len(failed) == 0
+assert all(document.id() not in server.items for document in deleted)
+
+print("Upload...")
+id = str(uuid.uuid4())
+path = os.path.join(INPUT_BASE_PATH, documents[0].id(), "%s.pdf" % documents[0].id())
+item = item_manager.upload_file(id, "", "Upload", "pdf", path)
+assert id in server.items and os.path.exists(item.orig_file())
+
+print("Offline...")
+server.stop()
+online_ids = set(document.id() for document in documents[50:]) | set([id])
+root, is_online = item_manager.get_root(force=True)
+documents = []
+item_manager.traverse_tree(fun=documents.append, document=True, collection=False)
+assert not is_online
+assert set(document.id() for document in documents) == online_ids
+assert all(document.state == model.item.STATE_SYNCED for document in documents)
+assert all(document.bookmarked() for document in documents if document.id() != id)
+
+# Stale local files are deleted in the background
+while item_manager.reaper is not None:
+    time.sleep(0.1)
+shutil.rmtree(TMP_PATH)
+print("Ok")
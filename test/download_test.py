@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Use a temporary config such that the user config is not touched
+TMP_PATH = tempfile.mkdtemp()
+os.environ["XDG_CONFIG_HOME"] = TMP_PATH
+
+import utils.config as cfg
+import api.remarkable_client
+from api.remarkable_client import RemarkableClient
+
+BLOB = os.urandom(3 * 1024 * 1024 + 123)
+DROP_AFTER = 1024 * 1024
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    """ Serves BLOB with range support. /flaky drops the connection after
+        DROP_AFTER bytes of every response and /expired is rejected
+        like an expired blob url.
+    """
+    protocol_version = "HTTP/1.1"
+    requests = []
+
+    def do_GET(self):
+        FlakyHandler.requests.append((self.path, self.headers.get("Range")))
+        if self.path == "/expired":
+            self.send_response(403)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        offset = 0
+        range_header = self.headers.get("Range")
+        if range_header and self.headers.get("If-Range") == '"blob"':
+            offset = int(range_header[len("bytes="):].split("-")[0])
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (offset, len(BLOB) - 1, len(BLOB)))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(BLOB) - offset))
+        self.send_header("ETag", '"blob"')
+        self.end_headers()
+
+        data = BLOB[offset:]
+        if self.path == "/flaky":
+            data = data[:DROP_AFTER]
+            self.close_connection = True
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def download(path, refresh_url=None):
+    FlakyHandler.requests = []
+    output = os.path.join(TMP_PATH, "blob.zip")
+    client.get_raw_file("%s%s" % (base_url, path), output, refresh_url=refresh_url)
+
+    with open(output, "rb") as f:
+        assert f.read() == BLOB
+    assert not os.path.exists(api.remarkable_client.get_path_part(output))
+    os.remove(output)
+    return FlakyHandler.requests
+
+
+cfg.save({"network": {"retries": 5, "backoff": 0.01}})
+server = ThreadingHTTPServer(("127.0.0.1", 0), FlakyHandler)
+server.daemon_threads = True
+threading.Thread(target=server.serve_forever, daemon=True).start()
+base_url = "http://127.0.0.1:%d" % server.server_address[1]
+client = RemarkableClient()
+
+print("Download without failures...")
+requests = download("/ok")
+assert len(requests) == 1
+
+print("Resume download after dropped connections...")
+requests = download("/flaky")
+assert len(requests) == 4
+assert requests[1][1] == "bytes=%d-" % DROP_AFTER
+
+print("Refresh expired url...")
+requests = download("/expired", refresh_url=lambda: "%s/ok" % base_url)
+assert [r[0] for r in requests] == ["/expired", "/ok"]
+
+print("Fail if no new url is available...")
+try:
+    download("/expired", refresh_url=lambda: None)
+    assert False
+except Exception as e:
+    assert "no new url" in str(e)
+
+server.shutdown()
+shutil.rmtree(TMP_PATH)
+print("Ok")
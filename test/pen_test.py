@@ -0,0 +1,51 @@
+import numpy as np
+
+import model.render as render
+
+PEN_NRS = [0, 1, 2, 3, 4, 5, 6, 7, 8, 12, 13, 14, 15, 16, 17, 18, 21]
+STROKES = 50
+
+
+def scalar_stroke(pen, speed, tilt, width, pressure):
+    """ Per segment computation as done by the renderer before the batch
+        form existed.
+    """
+    widths, opacities, colors = [], [], []
+    last_width = 0
+    for i in range(len(speed)):
+        if i % pen.segment_length == 0:
+            args = (float(speed[i]), float(tilt[i]), float(width[i]), float(pressure[i]), last_width)
+            segment_color = pen.get_segment_color(*args)
+            segment_width = pen.get_segment_width(*args)
+            segment_opacity = pen.get_segment_opacity(*args)
+
+        widths.append(segment_width)
+        opacities.append(segment_opacity)
+        colors.append(segment_color.rgba())
+        last_width = segment_width
+    return widths, opacities, colors
+
+
+def compare(pen_nr, rng):
+    length = rng.randint(1, 400)
+    speed = rng.uniform(0, 80, length).astype(np.float32)
+    tilt = rng.uniform(0, 1.5, length).astype(np.float32)
+    width = rng.uniform(1, 4, length).astype(np.float32)
+    pressure = rng.uniform(0, 1, length).astype(np.float32)
+
+    pen = render._get_pen(pen_nr, rng.choice([1.875, 2.0, 2.125]), rng.randint(0, 3), rng.uniform(0.5, 2))
+    widths, opacities, colors = scalar_stroke(pen, speed, tilt, width, pressure)
+
+    batch_colors = pen.get_stroke_colors(speed, tilt, width, pressure)
+    assert np.allclose(pen.get_stroke_widths(speed, tilt, width, pressure), widths, rtol=1e-9, atol=1e-9), pen.name
+    assert np.allclose(pen.get_stroke_opacities(speed, tilt, width, pressure), opacities, rtol=1e-9, atol=1e-9), pen.name
+    for batch_color, color in zip(batch_colors, colors):
+        assert np.allclose(batch_color, color[:len(batch_color)], rtol=1e-9, atol=1e-9), pen.name
+
+
+rng = np.random.RandomState(0)
+for pen_nr in PEN_NRS:
+    print("Compare batch and scalar form of pen %d..." % pen_nr)
+    for _ in range(STROKES):
+        compare(pen_nr, rng)
+print("Ok")
@@ -0,0 +1,224 @@
+""" Benchmark of the rendering pipeline. Every stage (parsing, pen
+    evaluation, overlay drawing, merge and write) is timed separately
+    for the testcases and for synthetic notebooks. Results are written
+    as json such that different runs can be compared:
+
+        PYTHONPATH=. python test/render_benchmark.py --output new.json --baseline old.json
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from pdfrw import PdfReader, PdfWriter, PageMerge
+
+import model.render as render
+import model.rm_file as rm_file
+import rm_generator
+
+INPUT_BASE_PATH = "./testcases/"
+
+# A stage is reported as regression if it is slower than the baseline
+# by more than this factor
+REGRESSION_THRESHOLD = 1.2
+
+
+def benchmark_pages(pages, load_base_pages=None, repeat=3):
+    """ Time all stages for the given pages. pages is a list of
+        (rm_file_name, page_layout) tuples and load_base_pages returns
+        new pdf pages the overlays are merged into (blank pages if None).
+        The base pages are loaded again for every run as merging changes
+        them.
+    """
+    stages = {}
+
+    def measure(name, fun, setup=None):
+        """ setup is called (untimed) before every run and its result is
+            passed to fun.
+        """
+        best = None
+        for _ in range(repeat):
+            args = () if setup is None else (setup(),)
+            start = time.perf_counter()
+            result = fun(*args)
+            duration = time.perf_counter() - start
+            best = duration if best is None else min(best, duration)
+        stages[name] = best
+        return result
+
+    parsed = measure("parse", lambda: [rm_file.read("%s.rm" % name) for name, _ in pages])
+    measure("pens", lambda: [_evaluate_pens(page, layout) for page, (_, layout) in zip(parsed, pages)])
+    overlays = measure("overlay", lambda: [render._render_rm_data(name, layout) for name, layout in pages])
+
+    def get_base_pages():
+        if load_base_pages is None:
+            return [render._blank_page() for _ in overlays]
+        return load_base_pages()
+
+    def merge(base_pages):
+        for base_page, data in zip(base_pages, overlays):
+            overlay = PdfReader(io.BytesIO(data))
+            PageMerge(base_page).add(overlay.pages[0]).render()
+        return base_pages
+    merged = measure("merge", merge, setup=get_base_pages)
+
+    def write():
+        writer = PdfWriter()
+        for page in merged:
+            writer.addpage(page)
+        out = io.BytesIO()
+        writer.write(out)
+        return out.tell()
+    size = measure("write", write)
+
+    return {
+        "pages": len(pages),
+        "strokes": sum(page.num_strokes() for page in parsed),
+        "segments": sum(page.num_segments() for page in parsed),
+        "overlay_bytes": sum(len(data) for data in overlays),
+        "output_bytes": size,
+        "seconds": stages,
+    }
+
+
+def benchmark_testcases(repeat):
+    results = {}
+
+    path = os.path.join(INPUT_BASE_PATH, "annotation")
+    for id in sorted(os.listdir(path)):
+        pdf_path = os.path.join(path, id, "%s.pdf" % id)
+        base_pdf = PdfReader(pdf_path)
+        pages = []
+        page_nrs = []
+        for page_nr in range(base_pdf.numPages):
+            rm_file_name = os.path.join(path, id, id, "%d" % page_nr)
+            if os.path.exists("%s.rm" % rm_file_name):
+                pages.append((rm_file_name, render.PDFPageLayout(base_pdf.pages[page_nr])))
+                page_nrs.append(page_nr)
+
+        def load_base_pages(pdf_path=pdf_path, page_nrs=page_nrs):
+            base_pdf = PdfReader(pdf_path)
+            return [base_pdf.pages[page_nr] for page_nr in page_nrs]
+        results["annotation/%s" % id] = benchmark_pages(pages, load_base_pages, repeat)
+
+    path = os.path.join(INPUT_BASE_PATH, "notebook")
+    for id in sorted(os.listdir(path)):
+        with open(os.path.join(path, id, "%s.content" % id)) as f:
+            is_landscape = json.load(f).get("orientation", "portrait") == "landscape"
+        layout = render.PDFPageLayout(is_landscape=is_landscape)
+        rm_files = sorted(f for f in os.listdir(os.path.join(path, id, id)) if f.endswith(".rm"))
+        pages = [(os.path.join(path, id, id, f[:-3]), layout) for f in rm_files]
+        results["notebook/%s" % id] = benchmark_pages(pages, None, repeat)
+
+    return results
+
+
+def benchmark_synthetic(args):
+    results = {}
+    pens = [int(p) for p in args.pens.split(",")]
+
+    with tempfile.TemporaryDirectory() as path:
+        for version in (3, 5):
+            uuid = "synthetic_v%d" % version
+            rm_generator.write_notebook(
+                path, uuid,
+                pages=args.pages,
+                layers=args.layers,
+                strokes=args.strokes,
+                points=args.points,
+                pens=pens,
+                version=version)
+
+            layout = render.PDFPageLayout()
+            pages = [(os.path.join(path, uuid, "%d" % p), layout) for p in range(args.pages)]
+            result = benchmark_pages(pages, None, args.repeat)
+
+            # End to end including the process pool and the final write
+            start = time.perf_counter()
+            render.notebook(path, uuid, os.path.join(path, "%s.pdf" % uuid), False, max_workers=args.workers)
+            result["seconds"]["notebook"] = time.perf_counter() - start
+            results["synthetic/v%d" % version] = result
+
+    return results
+
+
+def compare(results, baseline):
+    """ Print the ratio of all stages compared to the baseline and return
+        the number of regressions.
+    """
+    regressions = 0
+    for name, result in sorted(results["benchmarks"].items()):
+        if name not in baseline["benchmarks"]:
+            continue
+
+        old = baseline["benchmarks"][name]["seconds"]
+        for stage, seconds in sorted(result["seconds"].items()):
+            if stage not in old or old[stage] <= 0:
+                continue
+
+            ratio = seconds / old[stage]
+            is_regression = ratio > REGRESSION_THRESHOLD
+            regressions += int(is_regression)
+            print("%-50s %-10s %8.4fs %8.4fs %6.2fx%s" % (
+                name, stage, old[stage], seconds, ratio, "  REGRESSION" if is_regression else ""))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the rendering of .rm files.")
+    parser.add_argument("--output", default="bench_output.json", help="Write results into this json file")
+    parser.add_argument("--baseline", default=None, help="Compare against the results of an earlier run")
+    parser.add_argument("--repeat", type=int, default=3, help="Take the best of n runs per stage")
+    parser.add_argument("--pages", type=int, default=20, help="Synthetic pages")
+    parser.add_argument("--layers", type=int, default=2, help="Synthetic layers per page")
+    parser.add_argument("--strokes", type=int, default=100, help="Synthetic strokes per layer")
+    parser.add_argument("--points", type=int, default=200, help="Synthetic points per stroke")
+    parser.add_argument("--pens", default=",".join(str(p) for p in rm_generator.DEFAULT_PENS),
+                        help="Comma separated pen numbers used for synthetic strokes")
+    parser.add_argument("--workers", type=int, default=render.RENDER_WORKERS, help="Render processes")
+    args = parser.parse_args()
+
+    benchmarks = benchmark_testcases(args.repeat)
+    benchmarks.update(benchmark_synthetic(args))
+    results = {
+        "date": datetime.now().isoformat(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "arguments": vars(args),
+        "benchmarks": benchmarks,
+    }
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=4)
+
+    for name, result in sorted(benchmarks.items()):
+        stages = " ".join("%s=%.4fs" % (k, v) for k, v in result["seconds"].items())
+        print("%-50s %s" % (name, stages))
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print()
+        if compare(results, baseline) > 0:
+            sys.exit(1)
+
+
+def _evaluate_pens(page, page_layout):
+    for strokes in page.layers:
+        for stroke in strokes:
+            pen = render._get_pen(stroke.pen_nr, stroke.width, stroke.color, page_layout.scale)
+            if pen is None:
+                continue
+            s = stroke.segments
+            pen.get_stroke_widths(s["speed"], s["tilt"], s["width"], s["pressure"])
+            pen.get_stroke_opacities(s["speed"], s["tilt"], s["width"], s["pressure"])
+            pen.get_stroke_colors(s["speed"], s["tilt"], s["width"], s["pressure"])
+
+
+if __name__ == "__main__":
+    main()
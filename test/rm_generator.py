@@ -0,0 +1,100 @@
+import os
+import random
+import struct
+from pathlib import Path
+
+import model.rm_file as rm_file
+from model.render import DEFAULT_IMAGE_WIDTH, DEFAULT_IMAGE_HEIGHT
+
+
+#
+# DEFINITIONS
+#
+# Pen numbers of the most important tools (v5)
+PEN_BRUSH = 12
+PEN_PENCIL = 14
+PEN_BALLPOINT = 15
+PEN_MARKER = 16
+PEN_FINELINER = 17
+PEN_HIGHLIGHTER = 18
+PEN_MECHANICAL_PENCIL = 13
+PEN_CALLIGRAPHY = 21
+
+DEFAULT_PENS = [
+    PEN_BRUSH, PEN_PENCIL, PEN_BALLPOINT, PEN_MARKER,
+    PEN_FINELINER, PEN_HIGHLIGHTER, PEN_MECHANICAL_PENCIL, PEN_CALLIGRAPHY]
+
+
+#
+# API
+#
+def generate(layers=1, strokes=100, points=200, pens=DEFAULT_PENS, version=5, seed=0):
+    """ Create the content of a synthetic .rm file with the given number
+        of layers, strokes per layer and points per stroke. Pens are
+        chosen randomly from pens. Strokes are random walks such that
+        speed, tilt, width and pressure change smoothly as with real
+        handwriting.
+    """
+    rng = random.Random(seed)
+    header = rm_file.HEADER_V3 if version == 3 else rm_file.HEADER_V5
+
+    data = bytearray()
+    data += struct.pack('<{}sI'.format(len(header)), header, layers)
+    for _ in range(layers):
+        data += struct.pack('<I', strokes)
+        for _ in range(strokes):
+            pen_nr = rng.choice(pens)
+            color = rng.choice([0, 1, 2])
+            width = rng.choice([1.875, 2.0, 2.125])
+            if version == 3:
+                data += struct.pack('<IIIfI', pen_nr, color, 0, width, points)
+            else:
+                data += struct.pack('<IIIffI', pen_nr, color, 0, width, 0.0, points)
+            data += _random_walk(rng, points)
+
+    return bytes(data)
+
+
+def write_notebook(path, uuid, pages=1, template="Blank", **kwargs):
+    """ Create a notebook with the given number of synthetic pages that
+        can be rendered with model.render.notebook(path, uuid, ...).
+        kwargs are passed to generate().
+    """
+    rm_files_path = os.path.join(path, uuid)
+    Path(rm_files_path).mkdir(parents=True, exist_ok=True)
+
+    seed = kwargs.pop("seed", 0)
+    for page in range(pages):
+        with open(os.path.join(rm_files_path, "%d.rm" % page), "wb") as f:
+            f.write(generate(seed=seed + page, **kwargs))
+
+    with open(os.path.join(path, "%s.pagedata" % uuid), "w") as f:
+        f.write("\n".join([template] * pages))
+
+
+#
+# HELPER
+#
+def _random_walk(rng, points):
+    x = rng.uniform(100, DEFAULT_IMAGE_WIDTH - 100)
+    y = rng.uniform(100, DEFAULT_IMAGE_HEIGHT - 100)
+    speed, tilt, width, pressure = 20.0, 0.5, 2.0, 0.5
+    direction_x, direction_y = rng.uniform(-1, 1), rng.uniform(-1, 1)
+
+    data = bytearray()
+    for _ in range(points):
+        direction_x = _clamp(direction_x + rng.uniform(-0.3, 0.3), -1, 1)
+        direction_y = _clamp(direction_y + rng.uniform(-0.3, 0.3), -1, 1)
+        x = _clamp(x + 3 * direction_x, 0, DEFAULT_IMAGE_WIDTH)
+        y = _clamp(y + 3 * direction_y, 0, DEFAULT_IMAGE_HEIGHT)
+        speed = _clamp(speed + rng.uniform(-2, 2), 0, 80)
+        tilt = _clamp(tilt + rng.uniform(-0.05, 0.05), 0, 1.5)
+        width = _clamp(width + rng.uniform(-0.1, 0.1), 1, 4)
+        pressure = _clamp(pressure + rng.uniform(-0.05, 0.05), 0, 1)
+        data += struct.pack('<ffffff', x, y, speed, tilt, width, pressure)
+    return data
+
+
+def _clamp(value, low, high):
+    return max(low, min(high, value))
+
@@ -0,0 +1,71 @@
+import base64
+import io
+import json
+import os
+import re
+import struct
+import tempfile
+import zlib
+
+from pdfrw import PdfReader
+
+import model.render as render
+import model.rm_file as rm_file
+import rm_generator
+
+
+def generate_pencil_layers(layers, points=20):
+    """ One pencil stroke with full pressure (i.e. the same opacity for
+        every segment) per layer.
+    """
+    data = bytearray(struct.pack('<{}sI'.format(len(rm_file.HEADER_V5)), rm_file.HEADER_V5, layers))
+    for layer in range(layers):
+        data += struct.pack('<I', 1)
+        data += struct.pack('<IIIffI', rm_generator.PEN_PENCIL, 0, 0, 2.0, 0.0, points)
+        for i in range(points):
+            data += struct.pack('<ffffff', 100 + 10 * i, 100 + 100 * layer, 10.0, 0.0, 2.0, 1.0)
+    return bytes(data)
+
+
+def get_stroke_alphas(data):
+    """ Returns the stroke alpha (CA) that is active for every stroke
+        operator (S) of the overlay pdf.
+    """
+    page = PdfReader(io.BytesIO(data)).pages[0]
+    states = page.Resources.ExtGState or {}
+    content = page.Contents.stream
+    filters = page.Contents.Filter or []
+    if "/ASCII85Decode" in filters:
+        content = base64.a85decode(content.strip().rstrip("~>").encode("latin-1"))
+    if "/FlateDecode" in filters:
+        content = zlib.decompress(content)
+    if isinstance(content, bytes):
+        content = content.decode("latin-1")
+
+    alphas = []
+    alpha = 1.0
+    for match in re.finditer(r"/(\w+) gs|(?<![\w/])S(?!\w)", content):
+        if match.group(1) is not None:
+            state = states.get("/%s" % match.group(1))
+            if state is not None and state.CA is not None:
+                alpha = float(state.CA)
+        else:
+            alphas.append(alpha)
+    return alphas
+
+
+print("Render translucent strokes with different colors...")
+with tempfile.TemporaryDirectory() as path:
+    rm_file_name = os.path.join(path, "0")
+    with open("%s.rm" % rm_file_name, "wb") as f:
+        f.write(generate_pencil_layers(2))
+
+    # Every layer is drawn in its own color
+    with open("%s-metadata.json" % rm_file_name, "w") as f:
+        json.dump({"layers": [{"name": "#red"}, {"name": "#blue"}]}, f)
+
+    data = render._render_rm_data(rm_file_name, render.PDFPageLayout())
+    alphas = get_stroke_alphas(data)
+    assert len(alphas) == 2
+    assert all(abs(alpha - 0.7) < 1e-6 for alpha in alphas), alphas
+print("Ok")
@@ -1,12 +1,20 @@
 
+import copy
+import os
+import threading
 import yaml
 from pathlib import Path
-import os
+from uuid import uuid4
 
 PATH = Path.joinpath(Path.home(), ".remapy", "data")
 if "XDG_DATA_HOME" in os.environ:
     PATH = Path.joinpath(Path(os.getenv("XDG_DATA_HOME")), "remapy")
 
+# The parsed config is cached per process and only loaded again if the
+# mtime or size of the file changes.
+_cache_lock = threading.RLock()
+_cache = {"stat": None, "config": {}}
+
 
 def save(new_config: dict) -> None:
     """ Updates a complete section!
@@ -16,31 +24,32 @@ def save(new_config: dict) -> None:
 
     path = _get_path()
 
-    # Update keys and keep all old keys
-    config = load()
-    config.update(new_config)
-    
-    with open(path, 'w') as f:
-        content = yaml.dump(config)
-        f.write(content)
-    
+    with _cache_lock:
+        # Update keys and keep all old keys
+        config = load()
+        config.update(new_config)
+
+        # Write atomically such that other processes never read a
+        # partially written config
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = "%s.%s.tmp" % (path, uuid4().hex)
+        with open(tmp_path, 'w') as f:
+            content = yaml.dump(config)
+            f.write(content)
+        os.replace(tmp_path, path)
+
+        _cache["stat"] = _get_stat(path)
+        _cache["config"] = copy.deepcopy(config)
+
     return config
 
 
 def load() -> dict:
-    path = _get_path()
-    if not Path.exists(path):
-        return {}
-
-    with open(path, "r") as f:
-        content = f.read()
-        yml = yaml.load(content, Loader=yaml.FullLoader)
-        config = dict(yml)
-        return config
+    return copy.deepcopy(_get_cached())
 
 
 def exists(config_path) -> bool:    
-    config = load()
+    config = _get_cached()
     levels = config_path.split(".")
     for level in levels:
         if not level in config:
@@ -52,7 +61,7 @@ def exists(config_path) -> bool:
 
 
 def get(config_path, default=None):
-    config = load()
+    config = _get_cached()
     levels = config_path.split(".")
     for level in levels:
         if not level in config:
@@ -66,6 +75,34 @@ def get(config_path, default=None):
 #
 # HELPER
 #
+def _get_cached():
+    """ Returns the cached config (must not be modified) and reloads it
+        if the file changed.
+    """
+    path = _get_path()
+    with _cache_lock:
+        stat = _get_stat(path)
+        if stat != _cache["stat"]:
+            _cache["config"] = _read(path) if stat is not None else {}
+            _cache["stat"] = stat
+        return _cache["config"]
+
+
+def _read(path):
+    with open(path, "r") as f:
+        content = f.read()
+        yml = yaml.load(content, Loader=yaml.FullLoader)
+        return dict(yml or {})
+
+
+def _get_stat(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
 def _get_path():
     if "XDG_CONFIG_HOME" in os.environ:
         return Path.joinpath(Path(os.getenv("XDG_CONFIG_HOME")), "remapy", "config")